@@ -0,0 +1,79 @@
+"""Генератор синтетического "shop.xlsx" заданного размера.
+
+Запуск из корня проекта:
+
+    python benchmarks/generate_shop.py out.xlsx --items 1000 --admins 10 \
+        --transactions 100000
+"""
+import argparse
+import datetime
+import random
+
+from openpyxl import Workbook
+
+TRANSACTION_HEADER = (
+    'title', 'price', 'currency', 'name', 'email', 'phone_number',
+    'shipping_address', 'status', 'datetime'
+)
+
+
+def generate_shop(path, items, admins, transactions, blank_every=0, seed=0):
+    """Пишет книгу с листами admin, shop и transactions.
+
+    blank_every > 0 вставляет пустой ряд после каждых blank_every
+    транзакций, чтобы было что удалять delete_unfilled_rows.
+    """
+    rnd = random.Random(seed)
+    workbook = Workbook(write_only=True)
+    admin_sheet = workbook.create_sheet('admin')
+    admin_sheet.append(['allowed_id'])
+    for i in range(admins):
+        admin_sheet.append([100000000 + i])
+    shop_sheet = workbook.create_sheet('shop')
+    shop_sheet.append(
+        ['named_id', 'title', 'price', 'currency', 'description', 'category']
+    )
+    for i in range(items):
+        shop_sheet.append(
+            [
+                f'item_{i}', f'Товар {i}', rnd.randint(100, 20000), 'RUB',
+                f'Описание товара {i}', f'Категория {i % 20}'
+            ]
+        )
+    transaction_sheet = workbook.create_sheet('transactions')
+    transaction_sheet.append(TRANSACTION_HEADER)
+    start = datetime.datetime(2023, 1, 1)
+    for i in range(transactions):
+        moment = start + datetime.timedelta(minutes=7 * i)
+        transaction_sheet.append(
+            [
+                f'Товар {rnd.randrange(max(items, 1))}',
+                rnd.randint(100, 20000), 'RUB', f'Покупатель {i}',
+                f'buyer{i}@example.com', f'+7900{i:07d}',
+                'RU Санкт-Петербург Невский 1 190000', 'Оплачено',
+                moment.strftime('%d-%m-%y %H:%M')
+            ]
+        )
+        if blank_every and (i + 1) % blank_every == 0:
+            transaction_sheet.append([None] * len(TRANSACTION_HEADER))
+    workbook.save(path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--transactions', type=int, default=0)
+    parser.add_argument('--blank-every', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_shop(
+        args.path, args.items, args.admins, args.transactions,
+        blank_every=args.blank_every, seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Сравнение памяти под каталог: прежние словари против записей Item.
+
+Запуск из корня проекта:
+
+    python benchmarks/item_memory.py --items 100000
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import LabeledPrice  # noqa: E402
+
+from xlsx_parser import build_item  # noqa: E402
+
+
+def build_rows(count):
+    """Ряды листа товаров, как их возвращает загрузчик."""
+    return [
+        [
+            f'item_{i}', f'Товар {i}', 100 + i % 5000, 'RUB',
+            f'Описание товара {i}', f'Категория {i % 20}'
+        ]
+        for i in range(count)
+    ]
+
+
+def build_dict_item(values):
+    """Прежний формат записи товара: словарь со списком LabeledPrice."""
+    return {
+        'prices': [LabeledPrice(values[1], values[2] * 100)],
+        'title': values[1],
+        'description': values[4],
+        'currency': values[3],
+        'category': values[5],
+    }
+
+
+def measure(builder, rows):
+    """Байты, которые занимает каталог поверх уже загруженных рядов."""
+    tracemalloc.start()
+    items = {row[0]: builder(row) for row in rows}
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=100000)
+    args = parser.parse_args()
+    rows = build_rows(args.items)
+    old = measure(build_dict_item, rows)
+    new = measure(build_item, rows)
+    print(f'Товаров: {args.items}')
+    print(f'dict + LabeledPrice: {old / 2 ** 20:.1f} МиБ')
+    print(f'Item (NamedTuple):   {new / 2 ** 20:.1f} МиБ')
+    print(f'Экономия: {(1 - new / old) * 100:.0f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Замеры функций xlsx_parser на синтетических книгах разного размера.
+
+Каждый замер выполняется в отдельном процессе, чтобы пиковая память
+(ru_maxrss) относилась только к нему. Каждый замер повторяется --repeats
+раз на свежей копии книги, в отчёт идёт лучшее время и медиана памяти.
+Замеры, загружающие книгу целиком (FULL_LOAD_CASES), на размерах больше
+FULL_LOAD_LIMIT не выполняются: такая книга не помещается в память
+openpyxl на обычной машине. Результаты сравниваются с
+сохранённым базовым замером benchmarks/baseline.json: если время или
+память выросли больше допустимого порога, скрипт сообщает о регрессии и
+завершается с кодом 1.
+
+Запуск из корня проекта:
+
+    python benchmarks/run.py                       # сравнить с baseline
+    python benchmarks/run.py --sizes 1000 10000    # только малые размеры
+    python benchmarks/run.py --repeats 5           # больше повторов
+    python benchmarks/run.py --save                # обновить baseline
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+CASES = (
+    'collect_items', 'collect_admins_id', 'load_shop', 'add_transaction',
+    'delete_unfilled_rows', 'calculate_total_marge'
+)
+# Замеры, которые загружают книгу в память целиком, и предел их размера
+FULL_LOAD_CASES = ('add_transaction', 'delete_unfilled_rows')
+FULL_LOAD_LIMIT = 100000
+# Пустой ряд после каждых BLANK_EVERY транзакций
+BLANK_EVERY = 100
+# Разница меньше этих значений считается шумом, а не регрессией
+NOISE_FLOOR = {'seconds': 0.05, 'peak_rss_mb': 5}
+
+
+def run_case(case, path):
+    """Выполняет один замер в текущем процессе, возвращает секунды."""
+    from openpyxl import load_workbook
+
+    from xlsx_parser import (
+        add_transaction, calculate_total_marge, collect_admins_id,
+        collect_items, delete_unfilled_rows
+    )
+    from xlsx_stream import load_shop
+
+    if case == 'delete_unfilled_rows':
+        workbook = load_workbook(path)
+        started = time.perf_counter()
+        delete_unfilled_rows(workbook['transactions'])
+        return time.perf_counter() - started
+    calls = {
+        'collect_items': lambda: collect_items(path, 'shop'),
+        'collect_admins_id': lambda: collect_admins_id(path, 'admin'),
+        'load_shop': lambda: load_shop(path),
+        'add_transaction': lambda: add_transaction(
+            path, 'transactions', title='Товар 1', price=100.0,
+            currency='RUB', name='Бенчмарк', email='bench@example.com',
+            phone_number='+79000000000', status='Оплачено',
+            datetime='01-01-24 12:00'
+        ),
+        'calculate_total_marge': lambda: calculate_total_marge(
+            path, total=True
+        ),
+    }
+    started = time.perf_counter()
+    calls[case]()
+    return time.perf_counter() - started
+
+
+def measure_once(case, source, workdir):
+    """Запускает замер в дочернем процессе на копии книги."""
+    path = os.path.join(workdir, f'{case}.xlsx')
+    shutil.copyfile(source, path)
+    output = subprocess.run(
+        [sys.executable, __file__, '--child', case, path],
+        check=True, capture_output=True, text=True, cwd=ROOT
+    ).stdout
+    os.remove(path)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(case, source, workdir, repeats):
+    """Лучшее время и медиана пиковой памяти за repeats замеров."""
+    runs = [measure_once(case, source, workdir) for _ in range(repeats)]
+    return {
+        'seconds': min(run['seconds'] for run in runs),
+        'peak_rss_mb': statistics.median(run['peak_rss_mb'] for run in runs),
+    }
+
+
+def child(case, path):
+    seconds = run_case(case, path)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {
+                'seconds': round(seconds, 4),
+                'peak_rss_mb': round(peak_kb / 1024, 1),
+            }
+        )
+    )
+
+
+def find_regressions(results, baseline, threshold):
+    """Замеры, которые хуже базовых больше чем на threshold."""
+    regressions = list()
+    for case, sizes in results.items():
+        for size, current in sizes.items():
+            base = baseline.get(case, {}).get(size)
+            if not base:
+                continue
+            for metric in ('seconds', 'peak_rss_mb'):
+                limit = max(
+                    base[metric] * (1 + threshold),
+                    base[metric] + NOISE_FLOOR[metric]
+                )
+                if current[metric] > limit:
+                    regressions.append(
+                        f'{case} [{size}] {metric}: '
+                        f'{base[metric]} -> {current[metric]}'
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument(
+        '--repeats', type=int, default=3,
+        help='сколько раз повторять каждый замер'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.25,
+        help='допустимый рост времени и памяти, доля от базового замера'
+    )
+    parser.add_argument(
+        '--save', action='store_true', help='записать результаты в baseline'
+    )
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    from benchmarks.generate_shop import generate_shop
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            source = os.path.join(workdir, f'shop_{size}.xlsx')
+            generate_shop(source, size, size, size, blank_every=BLANK_EVERY)
+            for case in args.cases:
+                if case in FULL_LOAD_CASES and size > FULL_LOAD_LIMIT:
+                    continue
+                result = measure(case, source, workdir, args.repeats)
+                results.setdefault(case, dict())[str(size)] = result
+                print(
+                    f'{case:<24}{size:>9} rows  {result["seconds"]:>9.3f} s'
+                    f'  {result["peak_rss_mb"]:>8.1f} MiB',
+                    flush=True
+                )
+            os.remove(source)
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file).get('results', dict())
+    if args.save:
+        for case, sizes in results.items():
+            baseline.setdefault(case, dict()).update(sizes)
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(
+                {
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'results': baseline,
+                },
+                file, indent=2, ensure_ascii=False
+            )
+            file.write('\n')
+        print(f'Базовый замер сохранён в {args.baseline}')
+        return
+    regressions = find_regressions(results, baseline, args.threshold)
+    if regressions:
+        print('Регрессии относительно базового замера:')
+        for line in regressions:
+            print('  ' + line)
+        sys.exit(1)
+    print('Регрессий нет')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Рассылка объявлений покупателям.
+
+Сообщение отправляется во все чаты, из которых когда-либо оплачивали
+заказ (колонка chat_id листа транзакций). Telegram ограничивает частоту
+отправки: около 30 сообщений в секунду на бота и одно сообщение в секунду
+в один чат, а при превышении отвечает ошибкой 429 с паузой retry_after.
+Поэтому отправка идёт через два токен-бакета, общий и на чат, несколькими
+параллельными воркерами, а ответ retry_after приостанавливает весь общий
+бакет.
+
+Прогресс пишется построчно в файл рассылки: первая строка - текст и список
+чатов, дальше по строке на каждый обработанный чат. После перезапуска бота
+рассылка продолжается с того места, где остановилась, а по окончании
+админу приходит отчёт о доставке.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telegram.error import (
+    BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+)
+
+from metrics import REGISTRY
+from xlsx_parser import TRANSACTION_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# Сообщений в секунду на всю рассылку
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+# Сообщений в секунду в один чат
+BROADCAST_CHAT_RATE = float(os.getenv('BROADCAST_CHAT_RATE', 1))
+# Сколько сообщений отправлять одновременно
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 8))
+# Сколько раз пытаться доставить сообщение в один чат
+BROADCAST_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', 3))
+BROADCAST_PROGRESS_PATH = os.getenv(
+    'BROADCAST_PROGRESS_PATH', 'shop.broadcast.jsonl'
+)
+
+SENT = 'sent'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+
+class TokenBucket:
+    """Токен-бакет: не больше rate операций в секунду, всплеск до burst."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Запрещает отправку на seconds секунд и обнуляет запас токенов."""
+        self._paused_until = max(
+            self._paused_until, time.monotonic() + seconds
+        )
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        """Ждёт свободный токен. Ожидающие обслуживаются по очереди."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcast:
+    """Рассылка с прогрессом в файле."""
+
+    def __init__(self, progress_path, text, chat_ids, report_chat_id,
+                 statuses=None):
+        self.progress_path = progress_path
+        self.text = text
+        self.chat_ids = chat_ids
+        self.report_chat_id = report_chat_id
+        # Итог по каждому уже обработанному чату
+        self.statuses = statuses or dict()
+        self.resumed = len(self.statuses)
+        self.started = time.monotonic()
+        self.task = None
+        self._file = None
+
+    @classmethod
+    def create(cls, progress_path, text, chat_ids, report_chat_id):
+        """Новая рассылка. Заголовок сразу пишется в файл прогресса."""
+        with open(progress_path, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(
+                {
+                    'text': text, 'report_chat_id': report_chat_id,
+                    'chat_ids': chat_ids
+                },
+                ensure_ascii=False
+            ) + '\n')
+        return cls(progress_path, text, chat_ids, report_chat_id)
+
+    @classmethod
+    def resume(cls, progress_path):
+        """Незавершённая рассылка из файла прогресса или None."""
+        if not os.path.exists(progress_path):
+            return None
+        statuses = dict()
+        with open(progress_path, encoding='utf-8') as file:
+            try:
+                header = json.loads(file.readline())
+            except json.JSONDecodeError:
+                logger.warning('Повреждён файл рассылки %s', progress_path)
+                return None
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Последняя строка могла не дописаться при падении
+                    continue
+                statuses[record['chat_id']] = record['status']
+        return cls(
+            progress_path, header['text'], header['chat_ids'],
+            header['report_chat_id'], statuses
+        )
+
+    def pending(self):
+        """Чаты, в которые ещё не отправляли."""
+        return [
+            chat_id for chat_id in self.chat_ids
+            if chat_id not in self.statuses
+        ]
+
+    def record(self, chat_id, status):
+        """Запоминает итог отправки в чат."""
+        if self._file is None:
+            self._file = open(self.progress_path, 'a', encoding='utf-8')
+        self.statuses[chat_id] = status
+        self._file.write(
+            json.dumps({'chat_id': chat_id, 'status': status}) + '\n'
+        )
+        self._file.flush()
+        REGISTRY.inc('broadcast_messages_total', status=status)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """Закрывает и удаляет файл прогресса завершённой рассылки."""
+        self.close()
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+    def counts(self):
+        result = {SENT: 0, BLOCKED: 0, FAILED: 0}
+        for status in self.statuses.values():
+            result[status] = result.get(status, 0) + 1
+        return result
+
+    def progress(self):
+        """Строка о ходе рассылки для /broadcast."""
+        counts = self.counts()
+        return (
+            f'Обработано {len(self.statuses)} из {len(self.chat_ids)}: '
+            f'доставлено {counts[SENT]}, заблокировали бота '
+            f'{counts[BLOCKED]}, ошибок {counts[FAILED]}'
+        )
+
+    def report(self):
+        """Отчёт о доставке после окончания рассылки."""
+        elapsed = time.monotonic() - self.started
+        lines = [
+            f'Рассылка завершена за {elapsed:.0f} с.',
+            self.progress(),
+        ]
+        if self.resumed:
+            lines.append(
+                f'Продолжена после перезапуска с {self.resumed} чатов.'
+            )
+        return '\n'.join(lines)
+
+
+async def deliver(send, chat_id, text, global_bucket, chat_bucket,
+                  max_attempts=BROADCAST_MAX_ATTEMPTS):
+    """Отправляет сообщение в чат с учётом лимитов, возвращает итог."""
+    for attempt in range(1, max_attempts + 1):
+        await chat_bucket.acquire()
+        await global_bucket.acquire()
+        try:
+            await send(chat_id, text)
+            return SENT
+        except RetryAfter as error:
+            # Флуд-контроль действует на бота целиком: останавливаем всех
+            REGISTRY.inc('broadcast_retry_after_total')
+            logger.warning(
+                'Флуд-контроль рассылки, пауза %s с', error.retry_after
+            )
+            global_bucket.pause(float(error.retry_after))
+            chat_bucket.pause(float(error.retry_after))
+        except Forbidden:
+            return BLOCKED
+        except BadRequest as error:
+            logger.info('Чат %s недоступен для рассылки: %s', chat_id, error)
+            return FAILED
+        except NetworkError as error:
+            logger.warning(
+                'Ошибка сети при рассылке в %s (попытка %s): %s',
+                chat_id, attempt, error
+            )
+            await asyncio.sleep(attempt)
+        except TelegramError as error:
+            logger.warning('Ошибка рассылки в %s: %s', chat_id, error)
+            return FAILED
+    return FAILED
+
+
+async def run_broadcast(broadcast, send, rate=BROADCAST_RATE,
+                        chat_rate=BROADCAST_CHAT_RATE,
+                        concurrency=BROADCAST_CONCURRENCY):
+    """Рассылает сообщение по всем необработанным чатам.
+
+    send - корутина send(chat_id, text), например bot.send_message.
+    """
+    global_bucket = TokenBucket(rate)
+    chat_buckets = dict()
+    chats = asyncio.Queue()
+    for chat_id in broadcast.pending():
+        chats.put_nowait(chat_id)
+
+    async def worker():
+        while not chats.empty():
+            chat_id = chats.get_nowait()
+            chat_bucket = chat_buckets.setdefault(
+                chat_id, TokenBucket(chat_rate)
+            )
+            status = await deliver(
+                send, chat_id, broadcast.text, global_bucket, chat_bucket
+            )
+            del chat_buckets[chat_id]
+            broadcast.record(chat_id, status)
+
+    try:
+        await asyncio.gather(
+            *(worker() for _ in range(max(1, concurrency)))
+        )
+    finally:
+        broadcast.close()
+    return broadcast
+
+
+async def run_and_report(broadcast, bot):
+    """Рассылка целиком: отправка, отчёт админу и удаление прогресса."""
+    await run_broadcast(broadcast, bot.send_message)
+    report = broadcast.report()
+    logger.info(report)
+    try:
+        await bot.send_message(broadcast.report_chat_id, report)
+    except TelegramError as error:
+        logger.warning('Отчёт о рассылке не отправлен: %s', error)
+    broadcast.finish()
+
+
+def collect_chat_ids(storage, journal):
+    """Чаты покупателей из хранилища и ещё не перенесённых оплат."""
+    chat_ids = list(storage.iter_chat_ids())
+    seen = set(chat_ids)
+    chat_column = TRANSACTION_COLUMNS.index('chat_id')
+    for row in journal.pending_rows():
+        chat_id = row[chat_column] if len(row) > chat_column else None
+        if chat_id and chat_id not in seen:
+            seen.add(chat_id)
+            chat_ids.append(chat_id)
+    return chat_ids
+
+
+def announcement_text(titles, limit=10):
+    """Текст объявления о новых товарах по умолчанию."""
+    lines = ['В магазине новинки:']
+    lines.extend(f'• {title}' for title in titles[:limit])
+    if len(titles) > limit:
+        lines.append(f'и ещё {len(titles) - limit}')
+    lines.append('Посмотреть товары: /show')
+    return '\n'.join(lines)
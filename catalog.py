@@ -0,0 +1,275 @@
+"""Постраничные клавиатуры каталога.
+
+Клавиатуры всех страниц строятся один раз для каждой ревизии каталога
+(при запуске и при вызове /update) и хранятся в словаре. Показ страницы
+сводится к поиску по ключу. Новая ревизия собирается целиком и подменяет
+старую одним присваиванием, так что обработчики всегда видят
+согласованный набор товаров и клавиатур.
+
+Новая ревизия может собираться по предыдущей: заготовки счетов и кнопок
+неизменившихся товаров, клавиатуры неизменившихся страниц и поисковый
+индекс (если не менялись тексты) берутся из неё, а не строятся заново.
+Старая ревизия при этом не меняется, так что обработчики, которые
+начали работу с ней, доводят её до конца на прежних данных.
+
+Закончившиеся товары (sold_out) остаются в ревизии, чтобы по ним можно
+было провести уже начатую оплату, но не попадают на страницы каталога.
+"""
+import os
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from invoices import build_invoice_options, build_shipping_choice_markup
+from search import SearchIndex
+from shipping import DEFAULT_TARIFF_ROWS, ShippingTariffs
+
+# Количество товаров на одной странице каталога
+PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', 10))
+
+# Название категории для товаров, у которых она не указана
+DEFAULT_CATEGORY = 'Другое'
+
+# Префиксы callback_data навигационных кнопок
+PAGE_PREFIX = 'page:'
+CATEGORY_PREFIX = 'cat:'
+CATEGORIES_DATA = 'categories'
+
+
+def page_data(category_idx, page):
+    """callback_data кнопки перехода на страницу."""
+    if category_idx is None:
+        return f'{PAGE_PREFIX}{page}'
+    return f'{CATEGORY_PREFIX}{category_idx}:{page}'
+
+
+def parse_page_data(data):
+    """Ключ страницы (номер категории или None, номер страницы)."""
+    if data.startswith(PAGE_PREFIX):
+        return None, int(data[len(PAGE_PREFIX):])
+    category_idx, page = data[len(CATEGORY_PREFIX):].split(':')
+    return int(category_idx), int(page)
+
+
+def is_navigation_data(data):
+    """Относится ли callback_data к навигации по каталогу."""
+    return (
+        data == CATEGORIES_DATA
+        or data.startswith(PAGE_PREFIX)
+        or data.startswith(CATEGORY_PREFIX)
+    )
+
+
+class Catalog:
+    """Ревизия каталога: товары, клавиатуры, счета и поисковый индекс."""
+
+    def __init__(self, items, page_size=PAGE_SIZE, previous=None,
+                 tariff_rows=None, sold_out=frozenset()):
+        self.items = items or dict()
+        self.page_size = page_size
+        self.sold_out = frozenset(sold_out)
+        # Товары, которые показываются на страницах каталога
+        self.visible = [
+            key for key in self.items if key not in self.sold_out
+        ]
+        self.categories = list()
+        self.pages = dict()
+        self.categories_markup = None
+        self.invoices = dict()
+        self.shipping_choices = dict()
+        # Клавиатуры страниц по их содержимому для переиспользования
+        # следующей ревизией
+        self._page_markups = dict()
+        if previous is not None and previous.page_size != page_size:
+            previous = None
+        self.reused = 0
+        for key, item in self.items.items():
+            if previous is not None and previous.items.get(key) == item:
+                self.invoices[key] = previous.invoices[key]
+                self.shipping_choices[key] = previous.shipping_choices[key]
+                self.reused += 1
+            else:
+                self.invoices[key] = build_invoice_options(key, item)
+                self.shipping_choices[key] = build_shipping_choice_markup(
+                    key
+                )
+        tariff_rows = [
+            tuple(row) for row in tariff_rows or DEFAULT_TARIFF_ROWS
+        ]
+        if previous is not None and previous.shipping.rows == tariff_rows:
+            # Тарифы не менялись: оставляем прежний индекс с его кэшем
+            self.shipping = previous.shipping
+        else:
+            self.shipping = ShippingTariffs(tariff_rows)
+        if previous is not None and self._same_texts(previous):
+            self.search_index = previous.search_index
+        else:
+            self.search_index = SearchIndex(self.items)
+        self._previous_markups = (
+            previous._page_markups if previous is not None else dict()
+        )
+        # Порядок категорий считается по всем товарам, а не только по
+        # видимым: иначе закончившийся товар сдвигал бы номера категорий
+        # и все их страницы пришлось бы перестраивать
+        grouped = dict()
+        for key, item in self.items.items():
+            grouped.setdefault(item.category, [])
+            if key not in self.sold_out:
+                grouped[item.category].append(key)
+        if set(grouped) - {None}:
+            # Хотя бы у одного товара есть категория: показываем
+            # сначала список категорий, а в нём постраничные товары
+            if None in grouped:
+                grouped.setdefault(DEFAULT_CATEGORY, []).extend(
+                    grouped.pop(None)
+                )
+            self.categories = list(grouped)
+            # Категории, в которых всё закончилось, не показываются
+            shown = [
+                (idx, category)
+                for idx, category in enumerate(self.categories)
+                if grouped[category]
+            ]
+            for idx, category in shown:
+                self._build_pages(idx, grouped[category])
+            self.categories_markup = InlineKeyboardMarkup(
+                [
+                    [
+                        InlineKeyboardButton(
+                            category, callback_data=page_data(idx, 0)
+                        )
+                    ] for idx, category in shown
+                ]
+            )
+        else:
+            self._build_pages(None, self.visible)
+        if self.categories_markup is not None:
+            # Список категорий тоже берём из прошлой ревизии, если он
+            # не изменился
+            signature = ('categories', tuple(shown))
+            self.categories_markup = self._previous_markups.get(
+                signature, self.categories_markup
+            )
+            self._page_markups[signature] = self.categories_markup
+        del self._previous_markups
+
+    def _same_texts(self, previous):
+        """Совпадают ли ключи, порядок и тексты товаров с прошлой ревизией."""
+        if list(previous.items) != list(self.items):
+            return False
+        return all(
+            (item.title, item.description) == (
+                previous.items[key].title, previous.items[key].description
+            )
+            for key, item in self.items.items()
+        )
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key):
+        """Характеристики товара по ключу или None."""
+        return self.items.get(key)
+
+    def in_stock(self, key):
+        """Есть ли товар в каталоге и не закончился ли он."""
+        return key in self.items and key not in self.sold_out
+
+    def with_sold_out(self, sold_out):
+        """Ревизия с теми же товарами, но другим набором закончившихся.
+
+        Перестраиваются только страницы, на которых что-то изменилось.
+        """
+        return Catalog(
+            self.items, self.page_size, previous=self,
+            tariff_rows=self.shipping.rows, sold_out=sold_out
+        )
+
+    def _build_pages(self, category_idx, keys):
+        pages_count = max(1, -(-len(keys) // self.page_size))
+        for page in range(pages_count):
+            chunk = keys[page * self.page_size:(page + 1) * self.page_size]
+            # Клавиатура страницы определяется кнопками товаров и
+            # навигацией, поэтому совпавшую берём из прошлой ревизии
+            signature = (
+                category_idx, page, pages_count,
+                tuple((key, self.items[key].title) for key in chunk)
+            )
+            markup = self._previous_markups.get(signature)
+            if markup is not None:
+                self.pages[(category_idx, page)] = markup
+                self._page_markups[signature] = markup
+                continue
+            keyboard = [
+                [
+                    InlineKeyboardButton(
+                        self.items[key].title, callback_data=key
+                    )
+                ] for key in chunk
+            ]
+            navigation = list()
+            if page > 0:
+                navigation.append(
+                    InlineKeyboardButton(
+                        '◀️', callback_data=page_data(category_idx, page - 1)
+                    )
+                )
+            if pages_count > 1:
+                navigation.append(
+                    InlineKeyboardButton(
+                        f'{page + 1}/{pages_count}',
+                        callback_data=page_data(category_idx, page)
+                    )
+                )
+            if page < pages_count - 1:
+                navigation.append(
+                    InlineKeyboardButton(
+                        '▶️', callback_data=page_data(category_idx, page + 1)
+                    )
+                )
+            if navigation:
+                keyboard.append(navigation)
+            if category_idx is not None:
+                keyboard.append(
+                    [
+                        InlineKeyboardButton(
+                            'К категориям', callback_data=CATEGORIES_DATA
+                        )
+                    ]
+                )
+            markup = InlineKeyboardMarkup(keyboard)
+            self.pages[(category_idx, page)] = markup
+            self._page_markups[signature] = markup
+
+    def first_markup(self):
+        """Клавиатура, с которой начинается просмотр каталога."""
+        if self.categories_markup:
+            return self.categories_markup
+        return self.pages.get((None, 0))
+
+    def markup_for(self, data):
+        """Клавиатура по callback_data навигации или None, если её нет."""
+        if data == CATEGORIES_DATA:
+            return self.categories_markup
+        try:
+            return self.pages.get(parse_page_data(data))
+        except ValueError:
+            return None
+
+
+def load_catalog(storage, previous=None, skip_unchanged=False):
+    """Загружает товары из хранилища и собирает по ним ревизию каталога.
+
+    Если передана предыдущая ревизия, неизменившиеся части берутся из неё.
+    С skip_unchanged возвращает None, не собирая ревизию, когда товары и
+    тарифы доставки совпадают с предыдущей.
+    """
+    items, _ = storage.load_shop()
+    tariff_rows = storage.load_tariffs()
+    if (
+            skip_unchanged and previous is not None
+            and list((items or dict()).items()) == list(previous.items.items())
+            and [tuple(row) for row in tariff_rows or DEFAULT_TARIFF_ROWS]
+            == previous.shipping.rows
+    ):
+        return None
+    return Catalog(items, previous=previous, tariff_rows=tariff_rows)
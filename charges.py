@@ -0,0 +1,56 @@
+"""Айди уже учтённых оплат для защиты от повторной обработки.
+
+Telegram может доставить SUCCESSFUL_PAYMENT повторно, например если бот
+упал или перезапустился, не успев подтвердить обновление. Каждая оплата
+записывается вместе с telegram_payment_charge_id и
+provider_payment_charge_id (колонки K и L листа транзакций), поэтому
+отдельного файла для учтённых оплат не нужно: при запуске айди собираются
+в множество за тот же проход по хранилищу и журналу, что и индекс выручки.
+Повтор отсекается проверкой по множеству до записи в журнал, списания
+остатка и письма покупателю.
+"""
+import threading
+
+from xlsx_parser import CHARGE_COLUMN
+
+
+class ChargeIndex:
+    """Множество telegram_payment_charge_id учтённых оплат."""
+
+    def __init__(self):
+        self._charges = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, charge_id):
+        return charge_id in self._charges
+
+    def __len__(self):
+        return len(self._charges)
+
+    def add_row(self, row):
+        """Учитывает строку транзакции.
+
+        False, если оплата этой строки уже учтена. Строки старых версий без
+        айди оплаты всегда считаются новыми.
+        """
+        charge_id = row[CHARGE_COLUMN] if len(row) > CHARGE_COLUMN else None
+        if not charge_id:
+            return True
+        return self.claim(charge_id)
+
+    def claim(self, charge_id):
+        """Отмечает оплату учтённой. False, если она уже была учтена.
+
+        Отметка ставится до первого await обработчика, поэтому из двух
+        одновременно пришедших копий обновления обработается только одна.
+        """
+        with self._lock:
+            if charge_id in self._charges:
+                return False
+            self._charges.add(charge_id)
+            return True
+
+    def release(self, charge_id):
+        """Снимает отметку, если оплату не удалось записать."""
+        with self._lock:
+            self._charges.discard(charge_id)
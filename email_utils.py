@@ -11,6 +11,13 @@ load_dotenv()
 YANDEX_MAIL_LOGIN = os.getenv('YANDEX_MAIL_LOGIN')
 YANDEX_MAIL_PASSWORD = os.getenv('YANDEX_MAIL_PASSWORD')
 
+# Параметры SMTP сервера. Переопределяются, например, для проверки
+# рассылки на локальном тестовом сервере (aiosmtpd).
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.yandex.ru')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 465))
+SMTP_SSL = os.getenv('SMTP_SSL', 'true').lower() in ('1', 'true', 'yes')
+MAIL_FROM = os.getenv('MAIL_FROM') or f'{YANDEX_MAIL_LOGIN}@yandex.ru'
+
 
 def build_message_from_kwargs(kwargs):
     """Форма для типового сообщения после успешной оплаты."""
@@ -18,7 +25,6 @@ def build_message_from_kwargs(kwargs):
         shipping_address = get_string_shipping_address(
             kwargs.get('shipping_address')
         )
-        print(shipping_address)
         text_message = (
             f'{kwargs.get("name")}! \n'
             f'Ваш заказ "{kwargs.get("title")}" оплачен'
@@ -36,21 +42,36 @@ def build_email(message, to):
     if to:
         msg = MIMEText(message)
         msg['Subject'] = 'Информация по заказу!'
-        msg['From'] = YANDEX_MAIL_LOGIN + '@yandex.ru'
+        msg['From'] = MAIL_FROM
         msg['To'] = to
         return msg
 
 
-def send_built_msg(message: MIMEText):
-    """Коннектится к серверу и отправляет имэйл."""
-    server = smtplib.SMTP_SSL('smtp.yandex.ru', port=465)
-    server.login(
-        YANDEX_MAIL_LOGIN,
-        YANDEX_MAIL_PASSWORD
-    )
+def open_smtp_connection():
+    """Открывает авторизованное соединение с SMTP сервером."""
+    if SMTP_SSL:
+        server = smtplib.SMTP_SSL(SMTP_HOST, port=SMTP_PORT, timeout=30)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, port=SMTP_PORT, timeout=30)
+    if YANDEX_MAIL_PASSWORD:
+        server.login(
+            YANDEX_MAIL_LOGIN,
+            YANDEX_MAIL_PASSWORD
+        )
+    return server
+
+
+def send_via_connection(server, message: MIMEText):
+    """Отправляет имэйл через уже открытое соединение."""
     server.sendmail(
         from_addr=message.get('From'),
         to_addrs=message.get('To'),
         msg=message.as_string()
     )
+
+
+def send_built_msg(message: MIMEText):
+    """Коннектится к серверу и отправляет имэйл."""
+    server = open_smtp_connection()
+    send_via_connection(server, message)
     server.quit()
@@ -0,0 +1,122 @@
+"""Единственный поток, через который идёт вся работа с хранилищем.
+
+openpyxl блокирует event loop, а параллельные load-modify-save одного и
+того же файла теряют строки. Поэтому обработчики не открывают книгу сами,
+а ставят команду в очередь этого потока и ждут результата через await.
+Команды выполняются строго по очереди. Если к моменту выполнения в очереди
+скопилось несколько одинаковых чтений или несколько записей транзакций в
+одно хранилище, они объединяются в одну операцию.
+"""
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Чтения, которые можно выполнить один раз для нескольких одинаковых
+# команд, стоящих в очереди подряд
+COALESCE_READS = {
+    'collect_items', 'collect_admins_id', 'calculate_total_marge',
+    'load_shop', 'load_catalog'
+}
+
+# Записи, последний позиционный аргумент которых - список строк. Подряд
+# идущие такие команды с одинаковыми остальными аргументами сливаются в
+# одну запись (xlsx_parser.add_transactions и Storage.add_transactions).
+MERGE_ROWS = 'add_transactions'
+
+
+def command_name(func):
+    """Имя функции или метода команды."""
+    return getattr(func, '__name__', None)
+
+
+class ExcelWorker:
+    """Поток-исполнитель команд над хранилищем и файлами эксель."""
+
+    def __init__(self):
+        self._commands = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._loop, name='excel-worker', daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Ставит команду в очередь, возвращает concurrent Future."""
+        self._ensure_started()
+        future = Future()
+        self._commands.put((func, args, kwargs, future))
+        return future
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет команду в потоке хранилища и возвращает результат."""
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def _drain(self):
+        """Ждёт первую команду и забирает всё, что успело накопиться."""
+        commands = [self._commands.get()]
+        while True:
+            try:
+                commands.append(self._commands.get_nowait())
+            except queue.Empty:
+                return commands
+
+    @staticmethod
+    def _batches(commands):
+        """Группирует подряд идущие команды, которые можно объединить."""
+        batches = list()
+        for command in commands:
+            func, args, kwargs, _ = command
+            if batches:
+                last_func, last_args, last_kwargs, _ = batches[-1][0]
+                name = command_name(func)
+                mergeable = (
+                    func == last_func
+                    and (
+                        name == MERGE_ROWS
+                        and args[:-1] == last_args[:-1]
+                        and not kwargs and not last_kwargs
+                        or name in COALESCE_READS
+                        and (args, kwargs) == (last_args, last_kwargs)
+                    )
+                )
+                if mergeable:
+                    batches[-1].append(command)
+                    continue
+            batches.append([command])
+        return batches
+
+    @staticmethod
+    def _execute(batch):
+        func, args, kwargs, _ = batch[0]
+        if command_name(func) == MERGE_ROWS and len(batch) > 1:
+            rows = [row for command in batch for row in command[1][-1]]
+            logger.info('Объединено записей транзакций: %s', len(batch))
+            return func(*args[:-1], rows)
+        return func(*args, **kwargs)
+
+    def _loop(self):
+        while True:
+            for batch in self._batches(self._drain()):
+                futures = [
+                    command[3] for command in batch
+                    if command[3].set_running_or_notify_cancel()
+                ]
+                if not futures:
+                    continue
+                try:
+                    result = self._execute(batch)
+                except Exception as error:
+                    for future in futures:
+                        future.set_exception(error)
+                else:
+                    for future in futures:
+                        future.set_result(result)
@@ -0,0 +1,95 @@
+"""Заготовки счетов и клавиатур выбора доставки для каждого товара.
+
+Заготовки собираются вместе с ревизией каталога, поэтому при нажатии
+"Да"/"Нет" остаётся только подставить chat_id и цену и отправить счёт.
+"""
+import os
+from urllib.parse import quote
+
+from dotenv import load_dotenv
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+load_dotenv()
+
+PROVIDER_TOKEN = os.getenv('PROVIDER_TOKEN')
+
+PHOTO_URL = 'https://i.ibb.co/JzS1x9r/photo-2023-01-14-18-49-35.jpg'
+# Адрес, по которому раздаётся каталог фотографий товаров. Счёт принимает
+# картинку только по ссылке, поэтому без него в счетах общая картинка
+PHOTO_BASE_URL = os.getenv('PHOTO_BASE_URL', '').rstrip('/')
+
+# Клавиатура под счётом одинакова для всех товаров
+INVOICE_MARKUP = InlineKeyboardMarkup(
+    [
+        [
+            InlineKeyboardButton(
+                'Оплатить',
+                pay=True,
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                'Показать все товары',
+                callback_data='show_items'
+            )
+        ]
+    ]
+)
+
+
+def invoice_photo_url(item):
+    """Ссылка на картинку товара для счёта или общая картинка магазина."""
+    if item.photo and PHOTO_BASE_URL:
+        return f'{PHOTO_BASE_URL}/{quote(item.photo)}'
+    return PHOTO_URL
+
+
+def build_invoice_options(key, item):
+    """Параметры счёта без доставки (False) и с доставкой (True).
+
+    Цены в заготовку не входят: LabeledPrice создаётся при отправке.
+    """
+    options = {
+        'title': item.title,
+        'description': item.description,
+        'payload': key,
+        'provider_token': PROVIDER_TOKEN,
+        'currency': item.currency,
+        'photo_url': invoice_photo_url(item),
+        'photo_height': 400,
+        'photo_width': 400,
+        'reply_markup': INVOICE_MARKUP,
+        'need_name': True,
+        'need_email': True,
+        'need_phone_number': True,
+    }
+    return {
+        False: dict(
+            options,
+            description=f'{item.description} (без доставки)'
+        ),
+        True: dict(
+            options,
+            description=f'{item.description} (с доставкой)',
+            need_shipping_address=True,
+            is_flexible=True
+        ),
+    }
+
+
+def build_shipping_choice_markup(key):
+    """Клавиатура вопроса "Вы хотите оформить доставку?"."""
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    'Да',
+                    callback_data=key + ' need_shipping'
+                ),
+                InlineKeyboardButton(
+                    'Нет',
+                    callback_data=key + ' no_shipping'
+                )
+            ]
+        ]
+    )
@@ -0,0 +1,99 @@
+"""Журнал транзакций с дозаписью.
+
+Каждая оплата дописывается одной строкой JSON в конец журнала и
+сбрасывается на диск через fsync, поэтому запись стоит O(1) и не зависит
+от объёма истории продаж. Фоновый компактор периодически переносит
+накопленные записи в хранилище (лист "transactions" файла "shop.xlsx" или
+таблицу SQLite) одной пачкой.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Интервал фоновой компакции журнала в секундах
+COMPACT_INTERVAL = int(os.getenv('JOURNAL_COMPACT_INTERVAL', 60))
+
+
+class TransactionJournal:
+    """Журнал транзакций, ожидающих переноса в хранилище."""
+
+    def __init__(self, journal_path, storage):
+        self.journal_path = journal_path
+        self.storage = storage
+        # Файл, в который журнал переименовывается на время компакции.
+        # Если процесс упал посреди компакции, файл подхватится при
+        # следующем запуске.
+        self.compacting_path = journal_path + '.compacting'
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+
+    def append(self, row):
+        """Дописывает строку транзакции в журнал и ждёт записи на диск."""
+        line = json.dumps(row, ensure_ascii=False, default=str) + '\n'
+        with self._lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+
+    @staticmethod
+    def _read_rows(path):
+        """Читает строки журнала, пропуская недописанный хвост."""
+        rows = list()
+        if not os.path.exists(path):
+            return rows
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Последняя строка могла не дописаться при падении
+                    logger.warning('Пропущена повреждённая строка журнала')
+        return rows
+
+    def pending_rows(self):
+        """Транзакции, ещё не перенесённые в хранилище."""
+        with self._lock:
+            return (
+                self._read_rows(self.compacting_path)
+                + self._read_rows(self.journal_path)
+            )
+
+    def compact(self):
+        """Переносит накопленные записи журнала в хранилище.
+
+        Возвращает количество перенесённых транзакций.
+        """
+        with self._compact_lock:
+            with self._lock:
+                if (
+                    not os.path.exists(self.compacting_path)
+                    and os.path.exists(self.journal_path)
+                ):
+                    os.replace(self.journal_path, self.compacting_path)
+            rows = self._read_rows(self.compacting_path)
+            if rows:
+                self.storage.add_transactions(rows)
+            if os.path.exists(self.compacting_path):
+                os.remove(self.compacting_path)
+            if rows:
+                logger.info('Из журнала перенесено транзакций: %s', len(rows))
+            return len(rows)
+
+
+async def run_compactor(journal, excel_worker, interval=COMPACT_INTERVAL):
+    """Фоновая задача, периодически сворачивающая журнал в хранилище.
+
+    Компакция выполняется в потоке эксель, чтобы не пересекаться с другими
+    операциями над хранилищем.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await excel_worker.run(journal.compact)
+        except Exception:
+            logger.exception('Не удалось перенести журнал транзакций')
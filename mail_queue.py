@@ -0,0 +1,147 @@
+"""Очередь исходящих писем.
+
+Обработчики только кладут письмо в очередь и сразу возвращают управление
+event loop. Отправкой занимается один воркер: он держит открытым одно
+авторизованное SMTP соединение, переподключается при обрыве, повторяет
+неудачные отправки с нарастающей паузой и при остановке бота дожидается,
+пока очередь опустеет. Письма, которые сервер отверг окончательно
+(ответ 5xx, например на опечатку в адресе покупателя), не повторяются.
+"""
+import asyncio
+import logging
+import os
+import smtplib
+
+from email_utils import open_smtp_connection, send_via_connection
+from metrics import REGISTRY, timed
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз пытаться отправить одно письмо
+MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS', 5))
+# Пауза перед первой повторной попыткой, далее удваивается
+RETRY_BACKOFF = float(os.getenv('MAIL_RETRY_BACKOFF', 1))
+# Через сколько секунд простоя закрывать соединение с сервером
+IDLE_TIMEOUT = float(os.getenv('MAIL_IDLE_TIMEOUT', 60))
+# Сколько ждать отправки оставшихся писем при остановке бота
+DRAIN_TIMEOUT = float(os.getenv('MAIL_DRAIN_TIMEOUT', 30))
+
+
+def is_permanent(error):
+    """Отверг ли сервер письмо окончательно, так что повтор бесполезен."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(
+            500 <= code < 600 for code, _ in error.recipients.values()
+        )
+    if isinstance(
+            error, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return 500 <= error.smtp_code < 600
+    return False
+
+
+class MailQueue:
+    """Асинхронная очередь писем с переиспользуемым SMTP соединением."""
+
+    def __init__(self, connect=open_smtp_connection):
+        self._connect = connect
+        self._queue = asyncio.Queue()
+        self._server = None
+        self._worker = None
+
+    def start(self):
+        """Запускает воркер отправки в текущем event loop."""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    def put(self, message):
+        """Ставит письмо в очередь, не дожидаясь отправки."""
+        if message is not None:
+            self._queue.put_nowait(message)
+
+    async def stop(self, timeout=DRAIN_TIMEOUT):
+        """Дожидается отправки писем из очереди и останавливает воркер."""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(
+                'Не отправлено писем при остановке: %s', self._queue.qsize()
+            )
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        await asyncio.to_thread(self._close)
+
+    def _close(self):
+        """Закрывает соединение с сервером, если оно открыто."""
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self._server = None
+
+    def _send(self, message):
+        """Отправляет письмо, при необходимости открывая соединение."""
+        with timed('smtp_send_seconds'):
+            if self._server is None:
+                self._server = self._connect()
+            try:
+                send_via_connection(self._server, message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # Сервер закрыл простаивающее соединение: переподключаемся
+                # один раз, не расходуя попытку. Остальные SMTPException
+                # тоже подклассы OSError, но обрывом соединения не являются
+                REGISTRY.inc('smtp_reconnects_total')
+                self._server = self._connect()
+                send_via_connection(self._server, message)
+
+    async def _deliver(self, message):
+        """Отправка письма с повторами и нарастающей паузой."""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                await asyncio.to_thread(self._send, message)
+                return True
+            except (smtplib.SMTPException, OSError) as error:
+                REGISTRY.inc('smtp_errors_total')
+                if is_permanent(error):
+                    # Соединение после отказа остаётся рабочим
+                    logger.error(
+                        'Сервер отверг письмо для %s: %s',
+                        message.get('To'), error
+                    )
+                    return False
+                await asyncio.to_thread(self._close)
+                if attempt == MAX_ATTEMPTS:
+                    logger.error(
+                        'Письмо для %s не отправлено: %s',
+                        message.get('To'), error
+                    )
+                    return False
+                delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+                logger.warning(
+                    'Ошибка отправки письма (попытка %s), повтор через %s с',
+                    attempt, delay
+                )
+                await asyncio.sleep(delay)
+
+    async def _run(self):
+        """Цикл воркера: берёт письма из очереди и отправляет их."""
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    self._queue.get(), IDLE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._close)
+                continue
+            try:
+                await self._deliver(message)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,204 @@
+"""Метрики задержек и ошибок бота.
+
+Гистограммы задержек обработчиков, чтения и сохранения книг openpyxl и
+отправки писем по SMTP, а также счётчики ошибок. Метрики отдаются в
+текстовом формате Prometheus локальным HTTP сервером и печатаются
+администратору командой /stats с перцентилями p50/p95/p99, посчитанными по
+последним замерам.
+"""
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Порт HTTP сервера метрик, 0 - не запускать сервер
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+
+# Границы корзин гистограмм в секундах
+BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+# Сколько последних замеров хранить для перцентилей
+RESERVOIR_SIZE = 2048
+
+
+class Histogram:
+    """Гистограмма с корзинами Prometheus и окном последних замеров."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for idx, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+
+    def percentiles(self, *quantiles):
+        """Перцентили по окну последних замеров."""
+        values = sorted(self.recent)
+        if not values:
+            return [0.0 for _ in quantiles]
+        return [
+            values[min(len(values) - 1, int(q * len(values)))]
+            for q in quantiles
+        ]
+
+
+class Registry:
+    """Набор гистограмм и счётчиков с метками."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render_prometheus(self):
+        """Все метрики в текстовом формате Prometheus."""
+        lines = list()
+        with self._lock:
+            for name in sorted({key[0] for key in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (hist_name, labels), histogram in sorted(
+                        self.histograms.items()):
+                    if hist_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        cumulative += count
+                        lines.append(
+                            f'{name}_bucket'
+                            f'{format_labels(labels, le=bound)} {cumulative}'
+                        )
+                    lines.append(
+                        f'{name}_bucket{format_labels(labels, le="+Inf")} '
+                        f'{histogram.count}'
+                    )
+                    lines.append(
+                        f'{name}_sum{format_labels(labels)} {histogram.sum}'
+                    )
+                    lines.append(
+                        f'{name}_count{format_labels(labels)} '
+                        f'{histogram.count}'
+                    )
+            for name in sorted({key[0] for key in self.counters}):
+                lines.append(f'# TYPE {name} counter')
+                for (counter_name, labels), value in sorted(
+                        self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Строки для /stats: число замеров, p50/p95/p99 и ошибки."""
+        lines = list()
+        with self._lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                p50, p95, p99 = histogram.percentiles(0.5, 0.95, 0.99)
+                label = ','.join(str(value) for _, value in labels)
+                errors = self.counters.get(
+                    ('handler_errors_total', labels), 0
+                )
+                line = (
+                    f'{name}{f"[{label}]" if label else ""}: '
+                    f'n={histogram.count} p50={p50 * 1000:.1f}ms '
+                    f'p95={p95 * 1000:.1f}ms p99={p99 * 1000:.1f}ms'
+                )
+                if errors:
+                    line += f' ошибок={errors}'
+                lines.append(line)
+        return lines
+
+
+def format_labels(labels, **extra):
+    """Метки в виде {a="1",b="2"}."""
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+REGISTRY = Registry()
+
+
+@contextmanager
+def timed(name, **labels):
+    """Замер длительности блока кода в гистограмму name."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - started, **labels)
+
+
+def instrument(handler):
+    """Декоратор обработчика: задержка и ошибки с меткой handler."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            REGISTRY.inc('handler_errors_total', handler=name)
+            raise
+        finally:
+            REGISTRY.observe(
+                'handler_latency_seconds', time.perf_counter() - started,
+                handler=name
+            )
+
+    return wrapper
+
+
+async def _serve_metrics(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = REGISTRY.render_prometheus().encode()
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+            b'Connection: close\r\n\r\n' + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Запускает HTTP сервер метрик, если задан порт."""
+    if not port:
+        return None
+    server = await asyncio.start_server(_serve_metrics, host, port)
+    logger.info('Метрики доступны на http://%s:%s/metrics', host, port)
+    return server
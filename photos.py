@@ -0,0 +1,92 @@
+"""Фотографии товаров и кэш их file_id в Telegram.
+
+Колонка I (photo) листа "shop" содержит имя файла картинки в каталоге
+PHOTOS_DIR. Картинка загружается в Telegram один раз, при первом показе
+карточки товара, а возвращённый file_id запоминается в небольшом файле
+PHOTO_CACHE_PATH по sha256 содержимого картинки. Дальше карточки и
+результаты инлайн-поиска отправляются по file_id без повторной загрузки.
+
+Хеш файла пересчитывается только при изменении его времени изменения или
+размера, а новый file_id понадобится, только если поменялось содержимое:
+переименованная или скопированная картинка найдётся в кэше по хешу.
+"""
+import json
+import logging
+import os
+import threading
+
+from snapshot import file_digest
+
+logger = logging.getLogger(__name__)
+
+# Каталог с картинками товаров
+PHOTOS_DIR = os.getenv('PHOTOS_DIR', 'photos')
+# Файл кэша sha256 картинки -> file_id
+PHOTO_CACHE_PATH = os.getenv('PHOTO_CACHE_PATH', 'shop.photos.json')
+
+
+def photo_path(name, photos_dir=PHOTOS_DIR):
+    """Путь к картинке товара по значению колонки photo."""
+    return os.path.join(photos_dir, name)
+
+
+class PhotoCache:
+    """Постоянная карта sha256 картинки -> file_id в Telegram."""
+
+    def __init__(self, cache_path=PHOTO_CACHE_PATH):
+        self.cache_path = cache_path
+        self.file_ids = dict()
+        # путь -> (время изменения, размер, sha256), чтобы не читать
+        # неизменившийся файл заново
+        self._digests = dict()
+        self._lock = threading.Lock()
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, encoding='utf-8') as file:
+                    self.file_ids = json.load(file)
+            except (OSError, ValueError):
+                logger.warning('Кэш фотографий повреждён, будет создан заново')
+
+    def digest(self, path):
+        """sha256 картинки. Файл читается, только если он изменился."""
+        stat = os.stat(path)
+        known = self._digests.get(path)
+        if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return known[2]
+        digest = file_digest(path)
+        self._digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def lookup(self, path):
+        """(sha256, file_id или None) картинки. Читает файл при изменении."""
+        digest = self.digest(path)
+        return digest, self.file_ids.get(digest)
+
+    def known_file_id(self, path):
+        """file_id картинки, если её хеш уже известен, без чтения файла."""
+        known = self._digests.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not known or known[:2] != (stat.st_mtime_ns, stat.st_size):
+            return None
+        return self.file_ids.get(known[2])
+
+    def remember(self, digest, file_id):
+        """Запоминает file_id загруженной картинки и сохраняет кэш."""
+        with self._lock:
+            self.file_ids[digest] = file_id
+            self._save()
+
+    def forget(self, digest):
+        """Убирает file_id, который Telegram больше не принимает."""
+        with self._lock:
+            if self.file_ids.pop(digest, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.file_ids, file)
+        os.replace(tmp_path, self.cache_path)
@@ -0,0 +1,146 @@
+"""Отчёт о продажах для администраторов.
+
+Транзакции читаются из хранилища потоково (для книги эксель в режиме
+read_only/values_only, для SQLite курсором), в памяти копятся только
+суммы по товарам, валютам и дням, а файл отчёта пишется в режиме
+write_only. Поэтому память не растёт вместе с историей продаж.
+"""
+import csv
+import datetime
+import os
+import tempfile
+from collections import defaultdict
+
+from openpyxl import Workbook
+
+from xlsx_parser import parse_transaction_date, save_workbook
+
+REPORT_FORMATS = ('xlsx', 'csv')
+
+
+class SalesSummary:
+    """Количество продаж и выручка по товарам, валютам и дням."""
+
+    def __init__(self):
+        # ключ -> [количество, выручка]
+        self.by_item = defaultdict(lambda: [0, 0.0])
+        self.by_currency = defaultdict(lambda: [0, 0.0])
+        self.by_day = defaultdict(lambda: [0, 0.0])
+        # Разобранные даты по части "дд-мм-гг" строки: strptime на каждую
+        # из миллионов строк заметно дороже самого подсчёта
+        self._days = dict()
+
+    def parse_day(self, value):
+        """Дата транзакции с кэшем по дню."""
+        if not isinstance(value, str):
+            return parse_transaction_date(value)
+        key = value.strip()[:8]
+        if key not in self._days:
+            self._days[key] = parse_transaction_date(value)
+        return self._days[key]
+
+    def add(self, row, since=None):
+        """Учитывает строку транзакции, если она не раньше since."""
+        title, price, currency = row[0], row[1], row[2]
+        if not isinstance(price, (int, float)):
+            return
+        day = self.parse_day(row[8])
+        if since and (not day or day < since):
+            return
+        for totals in (
+                self.by_item[(title, currency)],
+                self.by_currency[currency],
+                self.by_day[(day, currency)]):
+            totals[0] += 1
+            totals[1] += price
+
+    def sections(self):
+        """Таблицы отчёта: название, заголовки и строки."""
+        return (
+            (
+                'by_item', ('title', 'currency', 'sales', 'revenue'),
+                [
+                    (title, currency, count, round(amount, 2))
+                    for (title, currency), (count, amount) in sorted(
+                        self.by_item.items(),
+                        key=lambda item: -item[1][1]
+                    )
+                ]
+            ),
+            (
+                'by_currency', ('currency', 'sales', 'revenue'),
+                [
+                    (currency, count, round(amount, 2))
+                    for currency, (count, amount) in sorted(
+                        self.by_currency.items(),
+                        key=lambda item: str(item[0])
+                    )
+                ]
+            ),
+            (
+                'by_day', ('date', 'currency', 'sales', 'revenue'),
+                [
+                    (day, currency, count, round(amount, 2))
+                    for (day, currency), (count, amount) in sorted(
+                        self.by_day.items(),
+                        key=lambda item: (
+                            item[0][0] or datetime.date.min, str(item[0][1])
+                        )
+                    )
+                ]
+            ),
+        )
+
+
+def write_xlsx_report(summary, path):
+    """Пишет отчёт листами by_item, by_currency и by_day."""
+    workbook = Workbook(write_only=True)
+    for title, headers, rows in summary.sections():
+        sheet = workbook.create_sheet(title)
+        sheet.append(headers)
+        for row in rows:
+            sheet.append(row)
+    save_workbook(workbook, path)
+
+
+def write_csv_report(summary, path):
+    """Пишет все таблицы отчёта в один CSV с колонкой section."""
+    with open(path, 'w', encoding='utf-8-sig', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(('section', 'key', 'currency', 'sales', 'revenue'))
+        for title, headers, rows in summary.sections():
+            for row in rows:
+                if len(row) == 3:
+                    # В таблице по валютам ключ и есть валюта
+                    row = (row[0],) + tuple(row)
+                writer.writerow((title,) + tuple(row))
+
+
+def build_sales_report(storage, journal, report_format='xlsx', days=None):
+    """Собирает отчёт о продажах и возвращает содержимое файла.
+
+    days - сколько последних дней (включая сегодня) учитывать, по
+    умолчанию вся история. Файл пишется во временный файл, свой для
+    каждого вызова, поэтому одновременные /report не мешают друг другу.
+    """
+    since = None
+    if days:
+        since = datetime.date.today() - datetime.timedelta(days=days - 1)
+    summary = SalesSummary()
+    for row in storage.iter_transactions():
+        summary.add(row, since)
+    for row in journal.pending_rows():
+        summary.add(row, since)
+    handle, path = tempfile.mkstemp(
+        prefix='shop.report.', suffix=f'.{report_format}'
+    )
+    os.close(handle)
+    try:
+        if report_format == 'csv':
+            write_csv_report(summary, path)
+        else:
+            write_xlsx_report(summary, path)
+        with open(path, 'rb') as file:
+            return file.read()
+    finally:
+        os.remove(path)
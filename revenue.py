@@ -0,0 +1,95 @@
+"""Индекс выручки по дням и валютам.
+
+Индекс строится один раз при запуске из транзакций хранилища и журнала
+неперенесённых оплат, а затем дополняется при каждой новой оплате. Поэтому
+команда /total не читает книгу эксель, а суммирует не больше тридцати
+дневных записей.
+"""
+import datetime
+import itertools
+import threading
+from collections import defaultdict
+
+from charges import ChargeIndex
+from xlsx_parser import parse_transaction_date
+
+# Периоды, которые показывает команда /total: подпись и число дней
+REPORT_PERIODS = (
+    ('Сегодня', 1),
+    ('За 7 дней', 7),
+    ('За 30 дней', 30),
+)
+
+
+class RevenueIndex:
+    """Накопительные суммы выручки по дням и валютам."""
+
+    def __init__(self):
+        self._days = defaultdict(lambda: defaultdict(float))
+        self._totals = defaultdict(float)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Индекс по строкам листа транзакций."""
+        index = cls()
+        for row in rows:
+            index.add(row)
+        return index
+
+    def add(self, row):
+        """Учитывает строку транзакции в колонках A-I."""
+        price, currency, date_value = row[1], row[2], row[8]
+        if not isinstance(price, (int, float)):
+            return
+        day = parse_transaction_date(date_value)
+        with self._lock:
+            self._totals[currency] += price
+            if day:
+                self._days[day][currency] += price
+
+    def period(self, days, today=None):
+        """Выручка по валютам за последние days дней, включая сегодня."""
+        today = today or datetime.date.today()
+        result = defaultdict(float)
+        with self._lock:
+            for offset in range(days):
+                day = today - datetime.timedelta(days=offset)
+                for currency, amount in self._days.get(day, {}).items():
+                    result[currency] += amount
+        return dict(result)
+
+    def total(self):
+        """Выручка по валютам за всё время."""
+        with self._lock:
+            return dict(self._totals)
+
+
+def build_revenue_index(storage, journal, charges=None):
+    """Строит индекс по хранилищу и ещё не перенесённым оплатам.
+
+    Если передан индекс оплат charges, он заполняется за тот же проход,
+    чтобы не читать историю транзакций дважды. Оплата, которая есть и в
+    хранилище, и в журнале (компакция прервалась после записи пачки),
+    учитывается один раз.
+    """
+    if charges is None:
+        charges = ChargeIndex()
+    index = RevenueIndex()
+    for row in itertools.chain(
+            storage.iter_transactions(), journal.pending_rows()):
+        if charges.add_row(row):
+            index.add(row)
+    return index
+
+
+def format_amounts(amounts):
+    """Строка вида "1500 RUB, 20 USD" или "0", если продаж не было."""
+    if not amounts:
+        return '0'
+    return ', '.join(
+        f'{round(amount, 2):g} {currency}'
+        for currency, amount in sorted(
+            amounts.items(), key=lambda item: str(item[0])
+        )
+    )
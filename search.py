@@ -0,0 +1,156 @@
+"""Поиск товаров по названию и описанию для инлайн-режима.
+
+Индекс строится вместе с ревизией каталога. Для запросов от трёх символов
+используется триграммный индекс: списки вхождений триграмм запроса
+пересекаются от самого короткого к самому длинному, пустое пересечение
+заканчивает поиск, а оставшиеся кандидаты проверяются поиском подстроки.
+Более короткие запросы ищутся по началу слов.
+
+Списки вхождений хранятся компактными массивами номеров товаров в порядке
+каталога. Списки частых триграмм (не короче 1/DENSE_FRACTION каталога)
+хранятся битовыми масками: маска занимает не больше места, чем такой
+массив, а пересекается одной операцией &.
+"""
+import bisect
+import itertools
+import re
+from array import array
+
+# Сколько результатов отдавать на один инлайн-запрос (ограничение Telegram)
+MAX_RESULTS = 50
+# Доля каталога, начиная с которой список вхождений хранится маской
+DENSE_FRACTION = 32
+
+WORDS = re.compile(r'\w+')
+NONZERO_BYTE = re.compile(rb'[^\x00]')
+# Номера установленных битов для каждого значения байта
+BYTE_BITS = tuple(
+    tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)
+)
+
+
+def normalize(text):
+    """Нижний регистр и одиночные пробелы."""
+    return ' '.join(str(text or '').lower().split())
+
+
+def trigrams(text):
+    """Множество триграмм строки."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def to_mask(posting, size):
+    """Битовая маска по возрастающему списку номеров товаров."""
+    bits = bytearray(size)
+    for idx in posting:
+        bits[idx >> 3] |= 1 << (idx & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def iter_mask(bits):
+    """Номера установленных битов маски (в байтах) по возрастанию."""
+    for match in NONZERO_BYTE.finditer(bits):
+        position = match.start()
+        base = position * 8
+        for bit in BYTE_BITS[bits[position]]:
+            yield base + bit
+
+
+def intersect(candidates, posting):
+    """Пересечение двух возрастающих списков номеров товаров.
+
+    Если кандидатов мало, каждый ищется в списке вхождений двоичным
+    поиском, иначе пересечение считается через множество.
+    """
+    if len(candidates) * len(posting).bit_length() < len(posting):
+        found = list()
+        for idx in candidates:
+            position = bisect.bisect_left(posting, idx)
+            if position < len(posting) and posting[position] == idx:
+                found.append(idx)
+        return found
+    return sorted(set(candidates).intersection(posting))
+
+
+class SearchIndex:
+    """Триграммный и префиксный индекс по названиям и описаниям товаров."""
+
+    def __init__(self, items):
+        self.keys = list()
+        self.texts = list()
+        self._trigrams = dict()
+        self._masks = dict()
+        self._prefixes = dict()
+        for key, item in items.items():
+            idx = len(self.keys)
+            text = normalize(f'{item.title} {item.description}')
+            self.keys.append(key)
+            self.texts.append(text)
+            for trigram in trigrams(text):
+                self._trigrams.setdefault(trigram, array('I')).append(idx)
+            prefixes = set()
+            for word in WORDS.findall(text):
+                prefixes.add(word[:1])
+                prefixes.add(word[:2])
+            for prefix in prefixes:
+                self._prefixes.setdefault(prefix, array('I')).append(idx)
+        self._mask_size = (len(self.keys) + 7) // 8
+        for trigram, posting in list(self._trigrams.items()):
+            if len(posting) * DENSE_FRACTION >= len(self.keys):
+                self._masks[trigram] = to_mask(posting, self._mask_size)
+                del self._trigrams[trigram]
+
+    def _candidates(self, query):
+        """Номера товаров, в тексте которых есть все триграммы запроса."""
+        postings = list()
+        mask = None
+        for trigram in trigrams(query):
+            dense = self._masks.get(trigram)
+            if dense is not None:
+                mask = dense if mask is None else mask & dense
+                continue
+            posting = self._trigrams.get(trigram)
+            if not posting:
+                return ()
+            postings.append(posting)
+        if mask == 0:
+            return ()
+        bits = mask and mask.to_bytes(self._mask_size, 'little')
+        if not postings:
+            return iter_mask(bits)
+        postings.sort(key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            candidates = intersect(candidates, posting)
+            if not candidates:
+                return ()
+        if bits:
+            candidates = [
+                idx for idx in candidates
+                if bits[idx >> 3] >> (idx & 7) & 1
+            ]
+        return candidates
+
+    def search(self, query, limit=MAX_RESULTS, exclude=frozenset()):
+        """Ключи товаров, подходящих под запрос, в порядке каталога.
+
+        Ключи из exclude, например закончившихся товаров, пропускаются до
+        отсечения по limit.
+        """
+        query = normalize(query)
+        if not query:
+            candidates = range(len(self.keys))
+        elif len(query) < 3:
+            candidates = self._prefixes.get(query, ())
+        else:
+            candidates = (
+                idx for idx in self._candidates(query)
+                if query in self.texts[idx]
+            )
+        return list(itertools.islice(
+            (
+                self.keys[idx] for idx in candidates
+                if self.keys[idx] not in exclude
+            ),
+            limit
+        ))
@@ -0,0 +1,143 @@
+"""Тарифы доставки из листа "shipping" книги магазина.
+
+Колонки листа:
+
+* A country - код страны ISO (RU, KZ), пусто или * - любая страна;
+* B postcode_prefix - начало почтового индекса, пусто - вся страна;
+* C max_weight - наибольший вес посылки в кг для тарифа, пусто - любой;
+* D option - название способа доставки, которое увидит покупатель;
+* E price - цена доставки в основных единицах валюты;
+* F currency - валюта цены, пусто - валюта товара.
+
+Для адреса берётся самый длинный совпавший префикс индекса (сначала в
+стране адреса, затем среди тарифов для любой страны), а для каждого
+способа доставки - тариф с наименьшим max_weight, не меньшим веса товара.
+Тарифы разложены по словарям страна -> префикс -> способ -> валюта с
+отсортированными весами, поэтому ответ на запрос доставки не зависит от
+размера таблицы. Готовые списки ShippingOption кэшируются по региону и
+тому, что в товаре важно для доставки: весу и валюте.
+"""
+import bisect
+import functools
+import math
+import os
+
+from telegram import LabeledPrice, ShippingOption
+
+# Сколько готовых списков вариантов доставки держать в кэше
+SHIPPING_CACHE_SIZE = int(os.getenv('SHIPPING_CACHE_SIZE', 4096))
+
+SHIPPING_SHEET = 'shipping'
+SHIPPING_COLUMNS = (
+    'country', 'postcode_prefix', 'max_weight', 'option', 'price',
+    'currency'
+)
+ANY_COUNTRY = ''
+
+# Тарифы на случай, если в книге нет листа shipping: прежние два варианта
+# CDEK для любого адреса
+DEFAULT_TARIFF_ROWS = (
+    (None, None, None, 'CDEK Москва', 354, None),
+    (None, None, None, 'CDEK Новосибирск', 404, None),
+)
+
+
+def normalize_postcode(value):
+    """Индекс без пробелов в верхнем регистре."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return ''.join(str(value).split()).upper()
+
+
+def normalize_country(value):
+    country = str(value or '').strip().upper()
+    return ANY_COUNTRY if country == '*' else country
+
+
+class ShippingTariffs:
+    """Индекс тарифов доставки с поиском по самому длинному префиксу."""
+
+    def __init__(self, rows):
+        self.rows = [tuple(row) for row in rows]
+        # страна -> префикс -> способ -> валюта -> (веса, цены)
+        self._index = dict()
+        # Самый длинный префикс по стране, чтобы не перебирать лишнее
+        self._max_prefix = dict()
+        tiers = dict()
+        for row in self.rows:
+            row = (list(row) + [None] * len(SHIPPING_COLUMNS))[
+                :len(SHIPPING_COLUMNS)
+            ]
+            country, prefix, max_weight, option, price, currency = row
+            if not option or not isinstance(price, (int, float)):
+                continue
+            country = normalize_country(country)
+            prefix = normalize_postcode(prefix)
+            if not isinstance(max_weight, (int, float)):
+                max_weight = math.inf
+            currency = str(currency or '').strip().upper()
+            tiers.setdefault(
+                (country, prefix, str(option), currency), list()
+            ).append((max_weight, round(price * 100)))
+            self._max_prefix[country] = max(
+                self._max_prefix.get(country, 0), len(prefix)
+            )
+        for (country, prefix, option, currency), values in tiers.items():
+            values.sort()
+            self._index.setdefault(country, dict()).setdefault(
+                prefix, dict()
+            ).setdefault(option, dict())[currency] = (
+                [weight for weight, _ in values],
+                [price for _, price in values],
+            )
+        self._cached_options = functools.lru_cache(
+            maxsize=SHIPPING_CACHE_SIZE
+        )(self._build_options)
+
+    def region(self, country_code, post_code):
+        """Совпавшие (страна, префикс) от самого длинного префикса."""
+        country = normalize_country(country_code)
+        postcode = normalize_postcode(post_code)
+        for country_key in dict.fromkeys((country, ANY_COUNTRY)):
+            prefixes = self._index.get(country_key)
+            if not prefixes:
+                continue
+            longest = min(len(postcode), self._max_prefix[country_key])
+            for length in range(longest, -1, -1):
+                if postcode[:length] in prefixes:
+                    yield country_key, postcode[:length]
+
+    def _build_options(self, country, prefix, weight, currency):
+        """Варианты доставки одного региона для веса и валюты товара."""
+        options = list()
+        for option, by_currency in self._index[country][prefix].items():
+            for currency_key in (currency, ''):
+                tiers = by_currency.get(currency_key)
+                if tiers is None:
+                    continue
+                weights, prices = tiers
+                idx = bisect.bisect_left(weights, weight)
+                if idx < len(weights):
+                    options.append(
+                        ShippingOption(
+                            str(len(options) + 1), option,
+                            [LabeledPrice(option, prices[idx])]
+                        )
+                    )
+                    break
+        return tuple(options)
+
+    def options_for(self, shipping_address, item):
+        """Варианты доставки товара по адресу или пустой список."""
+        weight = item.weight if isinstance(
+            item.weight, (int, float)
+        ) else 0
+        currency = str(item.currency or '').upper()
+        for country, prefix in self.region(
+                shipping_address.country_code, shipping_address.post_code):
+            options = self._cached_options(country, prefix, weight, currency)
+            if options:
+                return list(options)
+        return list()
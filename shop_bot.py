@@ -9,59 +9,115 @@ Telegram bot token и payment provider token следует указать в ф
 отправки необходимо в переменные окружения добавить значения логина и пароля
 для Yandex.
 """
+import asyncio
 import datetime
+import logging
 import os
 import re
+import time
 
 from dotenv import load_dotenv
 from telegram import (
-    InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, ShippingOption
+    InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle,
+    InlineQueryResultCachedPhoto, InputTextMessageContent
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
     PreCheckoutQueryHandler, MessageHandler, filters, ConversationHandler,
-    ShippingQueryHandler
+    ShippingQueryHandler, InlineQueryHandler
 )
 
-from email_utils import (
-    build_email, send_built_msg, build_message_from_kwargs
-)
-from xlsx_parser import (
-    collect_items, collect_admins_id, add_admin_to_excel, add_transaction,
-    calculate_total_marge
+from broadcast import (
+    BROADCAST_PROGRESS_PATH, Broadcast, announcement_text, collect_chat_ids,
+    run_and_report
 )
+from catalog import Catalog, is_navigation_data, load_catalog
+from charges import ChargeIndex
+from email_utils import build_email, build_message_from_kwargs
+from excel_worker import ExcelWorker
+from journal import TransactionJournal, run_compactor
+from mail_queue import MailQueue
+from metrics import REGISTRY, instrument, start_metrics_server
+from photos import PhotoCache, photo_path
+from report import REPORT_FORMATS, build_sales_report
+from revenue import REPORT_PERIODS, build_revenue_index, format_amounts
+from stock import StockLedger, run_stock_flusher
+from storage import open_storage
+from upload import format_diff, run_validation, shutdown_pool, staging_path
+from watcher import WATCH_INTERVAL, CatalogWatcher
+from xlsx_parser import build_transaction_row, read_file_bytes
 
 load_dotenv()
 
+logging.basicConfig(
+    format='%(asctime)s %(name)s %(levelname)s %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+STARTED = time.perf_counter()
+
 TOKEN = os.getenv('BOT_TOKEN')
-PROVIDER_TOKEN = os.getenv('PROVIDER_TOKEN')
 CONST_EXCEL_NAME = 'shop'
 
-# Словарбь товаров и их характеристик, полученный после парсинга
-# соответствущего xlsx-файла "shop.xlsx"
-ITEMS = collect_items('shop.xlsx', 'shop')
+# Способ получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Публичный адрес, который регистрируется в Telegram через setWebhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Сколько обновлений обрабатывать одновременно (0 - по одному)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 0))
+# Адрес Bot API, например локального сервера для тестов
+BOT_API_URL = os.getenv('BOT_API_URL')
+
+# Хранилище каталога, админов и транзакций: "shop.xlsx" или SQLite
+STORAGE = open_storage()
+
+# Словарь товаров и список id пользователей, у которых есть права
+# администратора
+_items, ADMINS = STORAGE.load_shop()
+
+# Остатки товаров с ограниченным количеством и их резервы на время оплаты
+STOCK = StockLedger()
+STOCK.sync(_items)
+
+# Ревизия каталога: словарь товаров и их характеристик и готовые
+# клавиатуры его страниц
+CATALOG = Catalog(
+    _items, tariff_rows=STORAGE.load_tariffs(), sold_out=STOCK.sold_out()
+)
+
+# file_id загруженных в Telegram фотографий товаров по хешу картинки
+PHOTOS = PhotoCache()
 
-# Список id пользователей, у которых есть права администратора
-ADMINS = collect_admins_id('shop.xlsx', 'admin')
+# Поток, через который последовательно идёт вся работа с хранилищем
+EXCEL = ExcelWorker()
+
+# Журнал оплат, который фоном переносится в лист "transactions"
+JOURNAL = TransactionJournal('shop.journal.jsonl', STORAGE)
+
+# Очередь писем покупателям, отправляемых в фоне
+MAIL_QUEUE = MailQueue()
+
+# Айди уже учтённых оплат, чтобы не обработать повтор обновления дважды
+CHARGES = ChargeIndex()
+
+# Выручка по дням и валютам для команды /total. Индекс оплат заполняется
+# за тот же проход по истории транзакций
+REVENUE = build_revenue_index(STORAGE, JOURNAL, CHARGES)
+
+logger.info(
+    'Данные магазина загружены за %.3f с', time.perf_counter() - STARTED
+)
 
 # ID возвращает функция start_add_admin(), как маркер состояния диалога
 ID = 0
 
-# Опции отправки
-SHIPPING_OPTIONS = [
-    ShippingOption(
-        '1', 'CDEK Москва', [
-            LabeledPrice('Доставка в Москву', 354 * 100),
-        ]
-    ),
-    ShippingOption(
-        '2', 'CDEK Новосибирск', [
-            LabeledPrice('Доставка в Новосибирск', 404 * 100),
-        ]
-    )
-]
-
 
+@instrument
 async def start(update, context):
     """Велкам мессадж."""
     keyboard = [
@@ -79,27 +135,19 @@ async def start(update, context):
     )
 
 
+@instrument
 async def show(update, context):
-    """Показать все доступные товары магазина в виде инлайн кнопок."""
-    if ITEMS:
-        # Параметры клавиатуры берутся из словаря характеристик товаров,
-        # который формируется при запуске скрипта или
+    """Показать первую страницу каталога в виде инлайн кнопок."""
+    catalog = CATALOG
+    if catalog.visible:
+        # Клавиатуры страниц собираются при запуске скрипта или
         # при вызове функции update()
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    ITEMS.get(item).get('title'),
-                    callback_data=item
-                )
-            ] for item in ITEMS
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text='Сейчас у нас в наличии: ',
-            reply_markup=reply_markup,
+            reply_markup=catalog.first_markup(),
         )
-    else:
+    elif update.callback_query:
         await update.callback_query.answer(
             text=(
                 'Список товаров пока недоступен для просмотра. '
@@ -107,62 +155,70 @@ async def show(update, context):
             ),
             show_alert=True
         )
+    else:
+        # Все товары могут закончиться: команда /show тоже получает ответ
+        await update.effective_message.reply_text(
+            'Список товаров пока недоступен для просмотра. '
+            'Попробуйте позже.'
+        )
 
 
+@instrument
 async def send_invoice(update, context, shipping: bool, key: str):
     """Отправляет счёт фактуру."""
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                'Оплатить',
-                pay=True,
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                'Показать все товары',
-                callback_data='show_items'
-            )
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    # Параметры инвойса берутся из словаря характеристик товаров,
-    # который формируется при запуске скрипта или
-    # при вызове функции update()
-    title = ITEMS.get(key).get('title')
-    description = ITEMS.get(key).get('description')
-    currency = ITEMS.get(key).get('currency')
-    prices = ITEMS.get(key).get('prices')
-    options = {
-        'chat_id': update.effective_chat.id,
-        'title': title,
-        'description': description,
-        'payload': key,
-        'provider_token': PROVIDER_TOKEN,
-        'currency': currency,
-        'prices': prices,
-        'photo_url': 'https://i.ibb.co/JzS1x9r/photo-2023-01-14-18-49-35.jpg',
-        'photo_height': 400,
-        'photo_width': 400,
-        'reply_markup': reply_markup,
-        'need_name': True,
-        'need_email': True,
-        'need_phone_number': True,
-    }
-    if shipping:
-        options['description'] += ' (с доставкой)'
-        await context.bot.send_invoice(
-            **options, need_shipping_address=True, is_flexible=True
-        )
+    # Параметры инвойса заготовлены для каждого товара при сборке
+    # ревизии каталога, остаётся только указать чат и цену
+    catalog = CATALOG
+    templates = catalog.invoices.get(key)
+    if templates is None or not catalog.in_stock(key):
+        await reject_unknown_item(update)
+        return
+    # Кнопки под сообщением из инлайн-режима не привязаны к чату с ботом,
+    # поэтому счёт отправляется покупателю в личные сообщения
+    if update.effective_chat:
+        chat_id = update.effective_chat.id
     else:
-        options['description'] += ' (без доставки)'
-        await context.bot.send_invoice(**options)
+        chat_id = update.effective_user.id
+    await context.bot.send_invoice(
+        chat_id=chat_id,
+        prices=catalog.get(key).labeled_prices(),
+        **templates[shipping]
+    )
+
 
+async def reject_unknown_item(update):
+    """Ответ на кнопку товара, которого нет в текущем каталоге."""
+    await update.callback_query.answer(
+        text='Этого товара больше нет в наличии.',
+        show_alert=True
+    )
+
+
+@instrument
+async def show_page(update, context):
+    """Листание каталога: подмена клавиатуры у того же сообщения."""
+    query = update.callback_query
+    reply_markup = CATALOG.markup_for(query.data)
+    if reply_markup is None:
+        # Кнопка осталась от прошлой ревизии каталога
+        await query.answer(text='Каталог обновился.')
+        await show(update, context)
+        return
+    await query.answer()
+    try:
+        await query.edit_message_reply_markup(reply_markup=reply_markup)
+    except BadRequest:
+        # Нажата кнопка текущей страницы: клавиатура не изменилась
+        pass
 
+
+@instrument
 async def callback_button(update, context):
     """Реакция на инлайн-кнопки."""
     if update.callback_query.data == 'show_items':
         await show(update, context)
+    elif is_navigation_data(update.callback_query.data):
+        await show_page(update, context)
     elif 'need_shipping' in update.callback_query.data:
         key = update.callback_query.data.split()[0]
         await send_invoice(update, context, shipping=True, key=key)
@@ -170,52 +226,163 @@ async def callback_button(update, context):
         key = update.callback_query.data.split()[0]
         await send_invoice(update, context, shipping=False, key=key)
     else:
-        item_title = ITEMS.get(update.callback_query.data).get('title')
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    'Да',
-                    callback_data=update.callback_query.data + ' need_shipping'
-                ),
-                InlineKeyboardButton(
-                    'Нет',
-                    callback_data=update.callback_query.data + ' no_shipping'
+        key = update.callback_query.data
+        # Ревизия каталога может смениться во время обработки: берём её
+        # один раз
+        catalog = CATALOG
+        if not catalog.in_stock(key):
+            await reject_unknown_item(update)
+            return
+        await send_item_card(
+            context.bot, update.effective_chat.id, catalog.get(key),
+            catalog.shipping_choices[key]
+        )
+
+
+async def send_item_card(bot, chat_id, item, reply_markup):
+    """Карточка товара с вопросом о доставке.
+
+    Если у товара есть фотография, она отправляется по file_id из кэша,
+    а при первом показе загружается в Telegram и file_id запоминается.
+    """
+    text = f'Вы хотите оформить доставку "{item.title}"?'
+    if item.photo:
+        path = photo_path(item.photo)
+        try:
+            digest, file_id = await asyncio.to_thread(PHOTOS.lookup, path)
+        except OSError:
+            logger.warning('Нет файла фотографии %s', path)
+        else:
+            if file_id:
+                try:
+                    await bot.send_photo(
+                        chat_id, file_id, caption=text,
+                        reply_markup=reply_markup
+                    )
+                    REGISTRY.inc('photo_cache_total', result='hit')
+                    return
+                except BadRequest:
+                    # file_id мог стать недействительным, например после
+                    # смены токена бота: загружаем картинку заново
+                    await asyncio.to_thread(PHOTOS.forget, digest)
+            photo = await asyncio.to_thread(read_file_bytes, path)
+            message = await bot.send_photo(
+                chat_id, photo, caption=text, reply_markup=reply_markup,
+                filename=item.photo
+            )
+            REGISTRY.inc('photo_cache_total', result='upload')
+            await asyncio.to_thread(
+                PHOTOS.remember, digest, message.photo[-1].file_id
+            )
+            return
+    await bot.send_message(
+        chat_id=chat_id, text=text, reply_markup=reply_markup
+    )
+
+
+@instrument
+async def inline_search(update, context):
+    """Поиск товаров в инлайн-режиме по названию и описанию."""
+    catalog = CATALOG
+    query = update.inline_query
+    results = list()
+    # Закончившиеся товары отсеиваются до ограничения числа результатов
+    for key in catalog.search_index.search(
+            query.query, exclude=catalog.sold_out):
+        item = catalog.get(key)
+        text = f'Вы хотите оформить доставку "{item.title}"?'
+        # Фотографию можно показать только уже загруженную в Telegram
+        file_id = item.photo and PHOTOS.known_file_id(photo_path(item.photo))
+        if file_id:
+            results.append(
+                InlineQueryResultCachedPhoto(
+                    id=key,
+                    photo_file_id=file_id,
+                    title=item.title,
+                    description=item.description,
+                    caption=text,
+                    reply_markup=catalog.shipping_choices[key],
                 )
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=f'Вы хотите оформить доставку "{item_title}"?',
-            reply_markup=reply_markup,
+            )
+            continue
+        results.append(
+            InlineQueryResultArticle(
+                id=key,
+                title=item.title,
+                description=item.description,
+                input_message_content=InputTextMessageContent(text),
+                reply_markup=catalog.shipping_choices[key],
+            )
         )
+    await query.answer(results, cache_time=10)
 
 
+@instrument
 async def precheckout_callback(update, context):
     """Проверка счёт-фактуры."""
     query = update.pre_checkout_query
-    if query.invoice_payload not in ITEMS:
+    if query.invoice_payload not in CATALOG:
         await query.answer(ok=False, error_message='Что-то пошло не так...')
-    else:
-        await query.answer(ok=True)
+        return
+    # Резерв снимает последний экземпляр с витрины, пока покупатель платит
+    if not STOCK.reserve(query.invoice_payload, query.from_user.id):
+        await query.answer(
+            ok=False,
+            error_message='К сожалению, этот товар уже закончился.'
+        )
+        return
+    refresh_sold_out(context.bot_data)
+    await query.answer(ok=True)
 
 
+@instrument
 async def successful_payment_callback(update, context):
     """Сообщение об успешной оплате."""
-    product_key = update.message.successful_payment.invoice_payload
-    order_info = update.message.successful_payment.order_info
+    payment = update.message.successful_payment
+    # Повтор обновления после перезапуска: оплата уже записана, а
+    # покупатель получил ответ и письмо
+    if not CHARGES.claim(payment.telegram_payment_charge_id):
+        REGISTRY.inc('payments_total', result='duplicate')
+        logger.warning(
+            'Повторное уведомление об оплате %s пропущено',
+            payment.telegram_payment_charge_id
+        )
+        # Резерв повторной проверки счёта не дождётся оплаты: возвращаем
+        # товар сразу, а не по истечении резерва
+        if STOCK.release(payment.invoice_payload, update.effective_user.id):
+            refresh_sold_out(context.bot_data)
+        return
+    REGISTRY.inc('payments_total', result='accepted')
+    product_key = payment.invoice_payload
+    order_info = payment.order_info
+    # Товар могли убрать из каталога между проверкой счёта и оплатой
+    item = CATALOG.get(product_key)
     kwargs = {
-        'title': ITEMS.get(product_key).get('title'),
-        'price': update.message.successful_payment.total_amount / 100,
-        'currency': update.message.successful_payment.currency,
+        'title': item.title if item else product_key,
+        'price': payment.total_amount / 100,
+        'currency': payment.currency,
         'name': order_info.name,
         'email': order_info.email,
         'phone_number': order_info.phone_number,
         'status': 'Оплачено',
         'datetime': datetime.datetime.now().strftime('%d-%m-%y %H:%M'),
-        'shipping_address': order_info.shipping_address
+        'shipping_address': order_info.shipping_address,
+        'chat_id': update.effective_chat.id,
+        'telegram_payment_charge_id': payment.telegram_payment_charge_id,
+        'provider_payment_charge_id': payment.provider_payment_charge_id
     }
-    add_transaction('shop.xlsx', sheet_name='transactions', **kwargs)
+    row = build_transaction_row(**kwargs)
+    try:
+        await asyncio.to_thread(JOURNAL.append, row)
+    except Exception:
+        # Оплата не записана: повтор обновления должен её обработать
+        CHARGES.release(payment.telegram_payment_charge_id)
+        raise
+    # Остаток списывается только после записи оплаты: иначе повтор
+    # незаписанной оплаты списал бы товар второй раз
+    STOCK.commit(product_key, update.effective_user.id)
+    refresh_sold_out(context.bot_data)
+    REVENUE.add(row)
     keyboard = [
         [InlineKeyboardButton('Показать товары', callback_data='show_items')]
     ]
@@ -227,9 +394,10 @@ async def successful_payment_callback(update, context):
     # Отправляем письмо с сообщением об успешной оплате
     text_message = build_message_from_kwargs(kwargs)
     email_message = build_email(text_message, kwargs.get('email'))
-    send_built_msg(email_message)
+    MAIL_QUEUE.put(email_message)
 
 
+@instrument
 async def venue(update, context):
     """Сообщение с меткой на карте."""
     await update.message.reply_venue(
@@ -240,18 +408,69 @@ async def venue(update, context):
     )
 
 
+def swap_catalog(bot_data, catalog):
+    """Подменяет ревизию каталога одним присваиванием.
+
+    Остатки сверяются с новой ревизией, а закончившиеся товары убираются
+    с её страниц. Возвращает названия новых товаров и запоминает их для
+    объявления командой /broadcast.
+    """
+    global CATALOG
+    STOCK.sync(catalog.items)
+    sold_out = STOCK.sold_out()
+    if sold_out != catalog.sold_out:
+        catalog = catalog.with_sold_out(sold_out)
+    previous, CATALOG = CATALOG, catalog
+    new_titles = [
+        item.title for key, item in catalog.items.items()
+        if key not in previous
+    ]
+    if new_titles:
+        bot_data['new_titles'] = new_titles
+    return new_titles
+
+
+def refresh_sold_out(bot_data):
+    """Убирает с витрины закончившиеся товары и возвращает освободившиеся.
+
+    Ревизия пересобирается только когда набор закончившихся изменился.
+    """
+    if STOCK.sold_out() != CATALOG.sold_out:
+        swap_catalog(bot_data, CATALOG)
+
+
+async def reload_catalog(app):
+    """Перечитывает каталог после изменения "shop.xlsx" на диске."""
+    previous = CATALOG
+    catalog = await EXCEL.run(
+        load_catalog, STORAGE, previous, skip_unchanged=True
+    )
+    if catalog is None:
+        # Книга поменялась, но не каталог: например, правили другой лист
+        return
+    swap_catalog(app.bot_data, catalog)
+    logger.info(
+        'Каталог перечитан, без перестройки товаров: %s из %s. %s',
+        catalog.reused, len(catalog.items),
+        format_diff(previous.items, catalog.items)
+    )
+
+
+@instrument
 async def update_shop(update, context):
     """Обновление списка товаров в магазине через парсинг эксель-файла."""
     if update.effective_user.id in ADMINS:
-        # Перезаписываем глобальную переменную, содержащую словарь с товарами
-        global ITEMS
-        ITEMS = collect_items('shop.xlsx', 'shop')
-        await update.message.reply_text(
-            text=(
-                'Ревизия успешно проведена!'
-            ),
-        )
-        return ITEMS
+        # Собираем новую ревизию каталога в потоке хранилища по текущей
+        catalog = await EXCEL.run(load_catalog, STORAGE, CATALOG)
+        new_titles = swap_catalog(context.bot_data, catalog)
+        text = 'Ревизия успешно проведена!'
+        if new_titles:
+            text += (
+                f'\nНовых товаров: {len(new_titles)}. '
+                'Сообщить о них покупателям: /broadcast'
+            )
+        await update.message.reply_text(text=text)
+        return CATALOG.items
     await update.message.reply_text(
         text=(
             'У вас не достаточно прав для инициализации ревизии.'
@@ -260,13 +479,58 @@ async def update_shop(update, context):
     )
 
 
+@instrument
+async def sales_report(update, context):
+    """Отчёт о продажах по товарам, валютам и дням.
+
+    /report [дней] [xlsx|csv], по умолчанию за всё время в xlsx.
+    """
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text(
+            text=(
+                'У вас не достаточно прав для получения отчёта. '
+                'За подробностями обратитесь к @ferdinand_the_second'
+            ),
+        )
+        return
+    days = None
+    report_format = 'xlsx'
+    for arg in context.args or ():
+        if arg.isdigit() and int(arg) > 0:
+            days = int(arg)
+        elif arg.lower() in REPORT_FORMATS:
+            report_format = arg.lower()
+        else:
+            await update.message.reply_text(
+                'Формат команды: /report [дней] [xlsx|csv]'
+            )
+            return
+    await update.message.reply_text('Собираю отчёт, пришлю файлом.')
+    # Отчёт читает всё хранилище, поэтому строится в его потоке
+    # Отчёт собирается и читается одним вызовом, чтобы администратор не
+    # получил чужой или недописанный файл
+    document = await EXCEL.run(
+        build_sales_report, STORAGE, JOURNAL, report_format, days
+    )
+    suffix = f'_{days}d' if days else ''
+    await update.message.reply_document(
+        document=document,
+        filename=f'sales_report{suffix}.{report_format}'
+    )
+
+
+@instrument
 async def download_excel_admin(update, context):
     """Скачать эксель файл со списком товаров и админов."""
     if update.effective_user.id in ADMINS:
-        with open('shop.xlsx', 'rb') as file:
-            await update.message.reply_document(
-                document=file
-            )
+        # Переносим накопленные оплаты, чтобы файл был актуальным
+        await EXCEL.run(JOURNAL.compact)
+        export_path = await EXCEL.run(STORAGE.export_xlsx)
+        document = await EXCEL.run(read_file_bytes, export_path)
+        await update.message.reply_document(
+            document=document,
+            filename='shop.xlsx'
+        )
     else:
         await update.message.reply_text(
             text=(
@@ -277,13 +541,37 @@ async def download_excel_admin(update, context):
         )
 
 
+@instrument
 async def upload_excel_admin(update, context):
     """Бот скачивает файл с товарами магазина."""
     if update.effective_user.id in ADMINS:
         if update.message.document.file_name == 'shop.xlsx':
             file = await context.bot.get_file(update.message.document.file_id)
-            await file.download_to_drive('shop.xlsx')
-            await update_shop(update, context)
+            # Скачиваем во временный файл рядом с книгой: недокачанный или
+            # битый файл не должен попасть в магазин
+            staged = staging_path(f'{CONST_EXCEL_NAME}.xlsx')
+            try:
+                await file.download_to_drive(staged)
+                items, _, tariffs, errors = await run_validation(staged)
+                if errors:
+                    await update.message.reply_text(
+                        'Файл не принят:\n' + '\n'.join(errors)
+                    )
+                    return
+                # Транзакции живой книги переносятся в новый файл, после
+                # чего он атомарно подменяет "shop.xlsx"
+                await EXCEL.run(STORAGE.import_xlsx, staged)
+            finally:
+                if os.path.exists(staged):
+                    os.remove(staged)
+            previous = CATALOG.items
+            catalog = await asyncio.to_thread(
+                Catalog, items, previous=CATALOG, tariff_rows=tariffs
+            )
+            swap_catalog(context.bot_data, catalog)
+            await update.message.reply_text(
+                'Каталог обновлён.\n' + format_diff(previous, catalog.items)
+            )
         else:
             await update.message.reply_text(
                 'Проверьте загружаемый файл. Он должен называться "shop.xlsx"'
@@ -297,15 +585,30 @@ async def upload_excel_admin(update, context):
         )
 
 
+@instrument
 async def shipping(update, context):
     """Отвечает на запрос отправки товара."""
     query = update.shipping_query
-    if query.invoice_payload not in ITEMS:
+    catalog = CATALOG
+    item = catalog.get(query.invoice_payload)
+    if item is None:
         await query.answer(ok=False, error_message='Что-то пошло не так...')
         return
-    await query.answer(ok=True, shipping_options=SHIPPING_OPTIONS)
+    # Тарифы проиндексированы вместе с ревизией каталога, поэтому ответ
+    # не требует обращения к хранилищу
+    shipping_options = catalog.shipping.options_for(
+        query.shipping_address, item
+    )
+    if not shipping_options:
+        await query.answer(
+            ok=False,
+            error_message='К сожалению, доставка по этому адресу недоступна.'
+        )
+        return
+    await query.answer(ok=True, shipping_options=shipping_options)
 
 
+@instrument
 async def start_add_admin(update, context):
     """Энтри поинт начала диалога для добавления нового админа."""
     if update.effective_user.id in ADMINS:
@@ -323,12 +626,13 @@ async def start_add_admin(update, context):
     return ConversationHandler.END
 
 
+@instrument
 async def validate_add_admin(update, context):
     """Валидация и запись нового админ айди в память и в эксель (БД)."""
     new_admin_id = update.message.text
     if re.fullmatch(r'[+]?\d{6,10}', new_admin_id):
         ADMINS.append(int(new_admin_id))
-        add_admin_to_excel('shop.xlsx', 'admin', admin_id=int(new_admin_id))
+        await EXCEL.run(STORAGE.add_admin, int(new_admin_id))
         await update.message.reply_text(
             'Новый админ успешно добавлен!'
         )
@@ -346,15 +650,29 @@ async def validate_add_admin(update, context):
         return ConversationHandler.END
 
 
+@instrument
 async def calculate_total(update, context):
-    """Тотал маржа."""
-    result = calculate_total_marge('shop.xlsx', total=True)
+    """Тотал маржа за сегодня, 7 и 30 дней и за всё время."""
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text(
+            text=(
+                'У вас не достаточно прав для просмотра выручки. '
+                'За подробностями обратитесь к @ferdinand_the_second'
+            ),
+        )
+        return
+    lines = [
+        f'{title}: {format_amounts(REVENUE.period(days))}'
+        for title, days in REPORT_PERIODS
+    ]
+    lines.append(f'За всё время: {format_amounts(REVENUE.total())}')
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=f'Общая выручка за всё время составляет: {result} рублей'
+        text='Выручка\n' + '\n'.join(lines)
     )
 
 
+@instrument
 async def cancel(update, context):
     """Конец конверсейшна с добавлением нового админа."""
     await update.message.reply_text(
@@ -363,14 +681,144 @@ async def cancel(update, context):
     return ConversationHandler.END
 
 
-def main():
-    """Запуск бота."""
-    app = ApplicationBuilder().token(TOKEN).build()
+@instrument
+async def stats(update, context):
+    """Перцентили задержек обработчиков, эксель и SMTP для админов."""
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text(
+            text=(
+                'У вас не достаточно прав для просмотра статистики. '
+                'За подробностями обратитесь к @ferdinand_the_second'
+            ),
+        )
+        return
+    lines = REGISTRY.summary() or ['Замеров пока нет.']
+    await update.message.reply_text('\n'.join(lines))
+
+
+def start_broadcast(app, broadcast):
+    """Запускает рассылку фоновой задачей."""
+    app.bot_data['broadcast'] = broadcast
+    broadcast.task = asyncio.create_task(run_and_report(broadcast, app.bot))
+
+
+@instrument
+async def broadcast_message(update, context):
+    """Рассылка объявления всем покупателям.
+
+    /broadcast <текст> рассылает текст, /broadcast без текста объявляет о
+    новинках последней ревизии или показывает ход текущей рассылки.
+    """
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text(
+            text=(
+                'У вас не достаточно прав для рассылки. '
+                'За подробностями обратитесь к @ferdinand_the_second'
+            ),
+        )
+        return
+    current = context.bot_data.get('broadcast')
+    if current and not current.task.done():
+        await update.message.reply_text(
+            'Рассылка уже идёт. ' + current.progress()
+        )
+        return
+    # Текст после команды (и @имени бота): объявление может начинаться
+    # с новой строки, поэтому делим не по первому пробелу
+    command = update.message.entities[0]
+    text = update.message.text[command.offset + command.length:].strip()
+    if not text and context.bot_data.get('new_titles'):
+        text = announcement_text(context.bot_data.pop('new_titles'))
+    if not text:
+        await update.message.reply_text(
+            'Укажите текст рассылки: /broadcast <текст>'
+        )
+        return
+    chat_ids = await EXCEL.run(collect_chat_ids, STORAGE, JOURNAL)
+    if not chat_ids:
+        await update.message.reply_text('Покупателей для рассылки пока нет.')
+        return
+    broadcast = await asyncio.to_thread(
+        Broadcast.create, BROADCAST_PROGRESS_PATH, text, chat_ids,
+        update.effective_chat.id
+    )
+    start_broadcast(context.application, broadcast)
+    await update.message.reply_text(
+        f'Рассылка запущена, получателей: {len(chat_ids)}. '
+        'По окончании пришлю отчёт.'
+    )
+
+
+async def on_startup(app):
+    """Дозапись журнала, оставшегося с прошлого запуска, и старт компактора."""
+    await EXCEL.run(STORAGE.rotate_transactions)
+    await EXCEL.run(JOURNAL.compact)
+    app.bot_data['compactor'] = asyncio.create_task(
+        run_compactor(JOURNAL, EXCEL)
+    )
+    app.bot_data['stock_flusher'] = asyncio.create_task(
+        run_stock_flusher(
+            STOCK, STORAGE, EXCEL, lambda: refresh_sold_out(app.bot_data)
+        )
+    )
+    MAIL_QUEUE.start()
+    app.bot_data['metrics_server'] = await start_metrics_server()
+    if STORAGE.source_path and WATCH_INTERVAL:
+        watcher = CatalogWatcher(
+            STORAGE.source_path, lambda: reload_catalog(app),
+            known_stat=lambda: STORAGE.known_stat
+        )
+        app.bot_data['watcher'] = asyncio.create_task(watcher.run())
+    # Рассылка, прерванная остановкой бота, продолжается с места остановки
+    broadcast = Broadcast.resume(BROADCAST_PROGRESS_PATH)
+    if broadcast:
+        logger.info('Продолжаем рассылку: %s', broadcast.progress())
+        start_broadcast(app, broadcast)
+
+
+async def on_shutdown(app):
+    """Остановка фоновых задач с отправкой писем и переносом журнала."""
+    for name in ('compactor', 'stock_flusher', 'watcher'):
+        task = app.bot_data.get(name)
+        if task:
+            task.cancel()
+    broadcast = app.bot_data.get('broadcast')
+    if broadcast and not broadcast.task.done():
+        # Прогресс уже на диске, рассылка продолжится при запуске
+        broadcast.task.cancel()
+        await asyncio.wait([broadcast.task])
+    metrics_server = app.bot_data.get('metrics_server')
+    if metrics_server:
+        metrics_server.close()
+    await MAIL_QUEUE.stop()
+    shutdown_pool()
+    await EXCEL.run(STOCK.flush, STORAGE)
+    await EXCEL.run(JOURNAL.compact)
+
+
+def build_application():
+    """Приложение бота со всеми обработчиками, ещё не запущенное."""
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if CONCURRENT_UPDATES:
+        builder.concurrent_updates(CONCURRENT_UPDATES)
+    if BOT_API_URL:
+        builder.base_url(f'{BOT_API_URL}/bot')
+        builder.base_file_url(f'{BOT_API_URL}/file/bot')
+    app = builder.build()
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('show', show))
     app.add_handler(CommandHandler('venue', venue))
     app.add_handler(CommandHandler('update', update_shop))
     app.add_handler(CommandHandler('download', download_excel_admin))
+    app.add_handler(CommandHandler('total', calculate_total))
+    app.add_handler(CommandHandler('stats', stats))
+    app.add_handler(CommandHandler('broadcast', broadcast_message))
+    app.add_handler(CommandHandler('report', sales_report))
     app.add_handler(
         MessageHandler(
             filters.Document.FileExtension('xlsx'),
@@ -392,12 +840,35 @@ def main():
         )
     )
     app.add_handler(CallbackQueryHandler(callback_button))
+    app.add_handler(InlineQueryHandler(inline_search))
     app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     app.add_handler(
         MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback)
     )
     app.add_handler(ShippingQueryHandler(shipping))
-    app.run_polling()
+    return app
+
+
+def main():
+    """Запуск бота."""
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        # Без секрета встроенный сервер принял бы обновления от кого угодно
+        raise SystemExit(
+            'Для BOT_MODE=webhook нужно задать WEBHOOK_SECRET'
+        )
+    app = build_application()
+    if BOT_MODE == 'webhook':
+        # Встроенный асинхронный HTTP сервер принимает обновления от
+        # Telegram и отклоняет запросы без правильного секретного токена
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
 
 
 if __name__ == '__main__':
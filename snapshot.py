@@ -0,0 +1,97 @@
+"""Снимок разобранного каталога для быстрого перезапуска бота.
+
+После разбора "shop.xlsx" товары и список админов сохраняются в бинарный
+файл вместе с хешем содержимого книги. При следующем запуске, если хеш
+книги не изменился, данные берутся из снимка и разбирать xlsx не нужно.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import time
+
+from xlsx_stream import load_shop
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.getenv('CATALOG_SNAPSHOT_PATH', 'shop.snapshot')
+
+# Меняется при изменении формата хранимых данных, чтобы старые снимки
+# не подхватывались новой версией бота
+SNAPSHOT_VERSION = 5
+
+
+def file_digest(file_path):
+    """sha256 содержимого файла."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_snapshot(snapshot_path, digest, sheets):
+    """Данные из снимка или None, если снимок устарел или повреждён."""
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        with open(snapshot_path, 'rb') as file:
+            snapshot = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        logger.warning('Снимок каталога повреждён, будет создан заново')
+        return None
+    if (
+        snapshot.get('version') != SNAPSHOT_VERSION
+        or snapshot.get('digest') != digest
+        or snapshot.get('sheets') != sheets
+    ):
+        return None
+    return snapshot.get('items'), snapshot.get('admins')
+
+
+def write_snapshot(snapshot_path, digest, sheets, items, admins):
+    """Атомарно сохраняет снимок рядом с книгой."""
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(
+            {
+                'version': SNAPSHOT_VERSION,
+                'digest': digest,
+                'sheets': sheets,
+                'items': items,
+                'admins': admins,
+            },
+            file,
+            protocol=pickle.HIGHEST_PROTOCOL
+        )
+    os.replace(tmp_path, snapshot_path)
+
+
+def load_shop_cached(xlsx_file_path, items_sheet='shop', admins_sheet='admin',
+                     snapshot_path=SNAPSHOT_PATH):
+    """Товары и айди админов из снимка или, если книга изменилась, из xlsx."""
+    if not os.path.exists(path=xlsx_file_path):
+        return None, None
+    started = time.perf_counter()
+    digest = file_digest(xlsx_file_path)
+    sheets = (items_sheet, admins_sheet)
+    cached = read_snapshot(snapshot_path, digest, sheets)
+    if cached is not None:
+        logger.info(
+            'Каталог загружен из снимка за %.3f с: товаров %s',
+            time.perf_counter() - started, len(cached[0])
+        )
+        return cached
+    items, admins = load_shop(xlsx_file_path, items_sheet, admins_sheet)
+    parsed = time.perf_counter()
+    try:
+        write_snapshot(snapshot_path, digest, sheets, items, admins)
+    except OSError:
+        logger.exception('Не удалось сохранить снимок каталога')
+    logger.info(
+        'Каталог разобран из %s за %.3f с (снимок сохранён за %.3f с): '
+        'товаров %s',
+        xlsx_file_path, parsed - started, time.perf_counter() - parsed,
+        len(items)
+    )
+    return items, admins
@@ -0,0 +1,227 @@
+"""Остатки товаров в памяти с резервированием на время оплаты.
+
+Остаток задаётся необязательной колонкой H (stock) листа "shop", пустая
+ячейка - количество не ограничено. Бот держит остатки счётчиками в памяти:
+
+* при проверке счёта (pre_checkout_query) одна единица товара
+  резервируется, и если свободных нет, оплата отклоняется. Пока покупатель
+  платит, последний экземпляр не продадут никому другому;
+* после успешной оплаты резерв списывается с остатка;
+* резерв, по которому за STOCK_RESERVATION_TIMEOUT секунд не пришла
+  оплата, снимается.
+
+Изменённые остатки не сохраняются на каждую продажу: фоновая задача раз в
+STOCK_FLUSH_INTERVAL секунд записывает их в хранилище одной пачкой.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд снимать резерв, по которому не пришла оплата
+STOCK_RESERVATION_TIMEOUT = float(
+    os.getenv('STOCK_RESERVATION_TIMEOUT', 600)
+)
+# Как часто записывать изменённые остатки в хранилище
+STOCK_FLUSH_INTERVAL = float(os.getenv('STOCK_FLUSH_INTERVAL', 30))
+
+
+class StockLedger:
+    """Счётчики остатков и резервы товаров с ограниченным количеством."""
+
+    def __init__(self, timeout=STOCK_RESERVATION_TIMEOUT):
+        self.timeout = timeout
+        # ключ -> остаток без учёта резервов
+        self.counts = dict()
+        # ключ -> список [срок резерва, айди покупателя]
+        self._reservations = dict()
+        # Значения колонки stock из последней загрузки каталога и
+        # последней записи бота: по ним sync отличает правку администратора
+        # от остатков, которые записал сам бот
+        self._loaded = dict()
+        self._stored = dict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def sync(self, items):
+        """Сверяет счётчики с остатками из только что загруженного каталога.
+
+        Остаток, изменённый администратором, заменяет счётчик. Значения,
+        которые записал сам бот, счётчик не трогают: с момента записи он мог
+        уйти дальше. items - None, если книги магазина нет.
+        """
+        items = items or dict()
+        with self._lock:
+            for key in list(self.counts):
+                if key not in items or items[key].stock is None:
+                    for state in (
+                            self.counts, self._reservations, self._loaded,
+                            self._stored):
+                        state.pop(key, None)
+                    self._dirty.discard(key)
+            for key, item in items.items():
+                if item.stock is None:
+                    continue
+                value = int(item.stock)
+                if self._loaded.get(key) == value:
+                    continue
+                self._loaded[key] = value
+                if key in self.counts and self._stored.get(key) == value:
+                    continue
+                self.counts[key] = value
+                self._stored[key] = value
+                self._dirty.discard(key)
+
+    def _reserved(self, key):
+        return len(self._reservations.get(key, ()))
+
+    def _release_expired(self, now):
+        released = 0
+        for key, reservations in list(self._reservations.items()):
+            alive = [
+                reservation for reservation in reservations
+                if reservation[0] > now
+            ]
+            released += len(reservations) - len(alive)
+            if alive:
+                self._reservations[key] = alive
+            else:
+                del self._reservations[key]
+        return released
+
+    def release_expired(self, now=None):
+        """Снимает просроченные резервы и возвращает их количество."""
+        with self._lock:
+            released = self._release_expired(now or time.monotonic())
+        if released:
+            REGISTRY.inc('stock_reservations_total', result='expired')
+            logger.info('Снято просроченных резервов: %s', released)
+        return released
+
+    def available(self, key):
+        """Свободный остаток товара или None, если он не ограничен."""
+        with self._lock:
+            if key not in self.counts:
+                return None
+            return self.counts[key] - self._reserved(key)
+
+    def reserve(self, key, user_id, now=None):
+        """Резервирует единицу товара. False, если свободных не осталось.
+
+        Повторная проверка счёта тем же покупателем, например после
+        отклонённой карты, продлевает его резерв, а не берёт ещё одну
+        единицу.
+        """
+        now = now or time.monotonic()
+        with self._lock:
+            if key not in self.counts:
+                return True
+            self._release_expired(now)
+            for reservation in self._reservations.get(key, ()):
+                if reservation[1] == user_id:
+                    reservation[0] = now + self.timeout
+                    return True
+            if self.counts[key] - self._reserved(key) <= 0:
+                REGISTRY.inc('stock_reservations_total', result='sold_out')
+                return False
+            self._reservations.setdefault(key, list()).append(
+                [now + self.timeout, user_id]
+            )
+        REGISTRY.inc('stock_reservations_total', result='reserved')
+        return True
+
+    def release(self, key, user_id):
+        """Снимает резерв покупателя, по которому оплаты уже не будет."""
+        with self._lock:
+            reservations = self._reservations.get(key)
+            if not reservations:
+                return False
+            for reservation in reservations:
+                if reservation[1] == user_id:
+                    reservations.remove(reservation)
+                    break
+            else:
+                return False
+            if not reservations:
+                del self._reservations[key]
+        REGISTRY.inc('stock_reservations_total', result='released')
+        return True
+
+    def commit(self, key, user_id):
+        """Списывает оплаченную единицу товара вместе с её резервом."""
+        with self._lock:
+            if key not in self.counts:
+                return
+            reservations = self._reservations.get(key, list())
+            for reservation in reservations:
+                if reservation[1] == user_id:
+                    reservations.remove(reservation)
+                    break
+            else:
+                # Резерв истёк до оплаты: деньги уже списаны, поэтому
+                # продажу всё равно учитываем
+                logger.warning(
+                    'Оплата товара %s без действующего резерва', key
+                )
+            if not reservations:
+                self._reservations.pop(key, None)
+            if self.counts[key] <= 0:
+                logger.warning('Товар %s продан сверх остатка', key)
+            self.counts[key] = max(0, self.counts[key] - 1)
+            self._dirty.add(key)
+
+    def sold_out(self):
+        """Ключи товаров, у которых не осталось свободных единиц."""
+        with self._lock:
+            return frozenset(
+                key for key, count in self.counts.items()
+                if count - self._reserved(key) <= 0
+            )
+
+    def flush(self, storage):
+        """Записывает изменённые остатки в хранилище одной пачкой.
+
+        Выполняется в потоке хранилища. Возвращает количество записанных
+        остатков.
+        """
+        with self._lock:
+            changes = {key: self.counts[key] for key in self._dirty}
+            self._dirty.clear()
+        if not changes:
+            return 0
+        try:
+            storage.save_stock(changes)
+        except Exception:
+            with self._lock:
+                self._dirty.update(
+                    key for key in changes if key in self.counts
+                )
+            raise
+        with self._lock:
+            for key, count in changes.items():
+                if key in self.counts:
+                    self._stored[key] = count
+        logger.info('Сохранено остатков товаров: %s', len(changes))
+        return len(changes)
+
+
+async def run_stock_flusher(ledger, storage, excel_worker, on_release=None,
+                            interval=STOCK_FLUSH_INTERVAL):
+    """Фоновая задача: снимает просроченные резервы и сохраняет остатки.
+
+    on_release() вызывается, если резервы были сняты, например чтобы
+    вернуть товары на витрину.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if ledger.release_expired() and on_release is not None:
+            on_release()
+        try:
+            await excel_worker.run(ledger.flush, storage)
+        except Exception:
+            logger.exception('Не удалось сохранить остатки товаров')
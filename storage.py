@@ -0,0 +1,450 @@
+"""Хранилище данных магазина: каталог, админы и транзакции.
+
+Бот работает с данными только через интерфейс Storage. Доступны два
+движка, выбираемые переменной окружения STORAGE_BACKEND:
+
+* excel (по умолчанию) - всё хранится в "shop.xlsx", как и раньше.
+  Транзакции закрытых месяцев переносятся в архивные книги каталога
+  TRANSACTIONS_ARCHIVE_DIR, чтобы живая книга оставалась небольшой;
+* sqlite - база SQLite в режиме WAL с индексами. Книга xlsx остаётся
+  форматом обмена: /download выгружает базу в xlsx, а загрузка файла
+  администратором импортирует из него каталог и список админов.
+
+Все вызовы методов хранилища из бота идут через поток ExcelWorker,
+поэтому запись всегда выполняется одним писателем.
+"""
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+
+from openpyxl import Workbook
+
+from snapshot import load_shop_cached
+from watcher import file_stat
+from xlsx_parser import (
+    SHOP_COLUMNS, TRANSACTION_COLUMNS, Item, add_admin_to_excel,
+    add_transactions, build_item, item_row,
+    initiate_transactions_sheet, iter_all_transaction_rows,
+    iter_transaction_rows, open_workbook, rotate_transactions,
+    save_stock_to_excel, save_workbook
+)
+from shipping import SHIPPING_COLUMNS, SHIPPING_SHEET
+from xlsx_stream import load_sheet_rows, load_shop
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'excel')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'shop.sqlite3')
+# Каталог архивных книг транзакций по месяцам
+TRANSACTIONS_ARCHIVE_DIR = os.getenv(
+    'TRANSACTIONS_ARCHIVE_DIR', 'transactions_archive'
+)
+
+# Колонки, добавленные после первой версии схемы базы
+ADDED_COLUMNS = {
+    'items': {'weight': 'REAL', 'stock': 'INTEGER', 'photo': 'TEXT'},
+    'transactions': {
+        'chat_id': 'INTEGER',
+        'telegram_payment_charge_id': 'TEXT',
+        'provider_payment_charge_id': 'TEXT',
+    },
+}
+# Колонки таблицы товаров в порядке ряда листа товаров
+ITEM_COLUMNS = ('key',) + Item._fields
+SELECT_ITEMS = f'SELECT {", ".join(ITEM_COLUMNS)} FROM items ORDER BY position'
+INSERT_ITEM = (
+    f'INSERT INTO items (position, {", ".join(ITEM_COLUMNS)}) '
+    f'VALUES ({", ".join("?" * (len(ITEM_COLUMNS) + 1))})'
+)
+INSERT_TRANSACTION = (
+    f'INSERT OR IGNORE INTO transactions ({", ".join(TRANSACTION_COLUMNS)}) '
+    f'VALUES ({", ".join("?" * len(TRANSACTION_COLUMNS))})'
+)
+SELECT_TRANSACTIONS = (
+    f'SELECT {", ".join(TRANSACTION_COLUMNS)} FROM transactions ORDER BY id'
+)
+
+
+class Storage:
+    """Интерфейс хранилища данных магазина."""
+
+    # Файл, правка которого на диске меняет каталог, если такой есть
+    source_path = None
+    # stat этого файла, уже учтённый ботом: после загрузки каталога или
+    # собственной записи. Наблюдатель не перечитывает файл с таким stat
+    known_stat = None
+
+    def load_shop(self):
+        """Словарь товаров и список айди админов."""
+        raise NotImplementedError
+
+    def add_admin(self, admin_id):
+        """Добавляет айди нового админа."""
+        raise NotImplementedError
+
+    def load_tariffs(self):
+        """Ряды таблицы тарифов доставки в колонках листа shipping."""
+        return list()
+
+    def save_stock(self, stock):
+        """Записывает остатки товаров {ключ: количество}."""
+        raise NotImplementedError
+
+    def add_transactions(self, rows):
+        """Записывает пачку строк транзакций в колонках A-L."""
+        raise NotImplementedError
+
+    def iter_transactions(self):
+        """Строки всех транзакций в порядке записи."""
+        raise NotImplementedError
+
+    def rotate_transactions(self):
+        """Переносит старые транзакции в архив, если хранилище это умеет."""
+        return 0
+
+    def iter_chat_ids(self):
+        """Айди чатов покупателей без повторов в порядке первых покупок."""
+        seen = set()
+        chat_column = TRANSACTION_COLUMNS.index('chat_id')
+        for row in self.iter_transactions():
+            chat_id = row[chat_column] if len(row) > chat_column else None
+            if chat_id and chat_id not in seen:
+                seen.add(chat_id)
+                yield chat_id
+
+    def export_xlsx(self):
+        """Путь к книге xlsx с актуальными данными для /download."""
+        raise NotImplementedError
+
+    def import_xlsx(self, xlsx_file_path):
+        """Принимает загруженную администратором книгу xlsx."""
+        raise NotImplementedError
+
+
+class ExcelStorage(Storage):
+    """Хранилище в книге эксель "shop.xlsx"."""
+
+    def __init__(self, xlsx_file_path='shop.xlsx',
+                 archive_dir=TRANSACTIONS_ARCHIVE_DIR):
+        self.xlsx_file_path = xlsx_file_path
+        self.source_path = xlsx_file_path
+        self.archive_dir = archive_dir
+        # Месяц последней ротации: проверять книгу чаще незачем
+        self._rotated_month = None
+
+    def _own_write(self, write, *args):
+        """Записывает книгу и запоминает её новый stat как уже учтённый.
+
+        Если перед записью книга отличалась от учтённой (её правили вне
+        бота), новый stat не запоминается: наблюдатель должен перечитать
+        каталог вместе с этой правкой.
+        """
+        foreign = file_stat(self.xlsx_file_path) != self.known_stat
+        result = write(*args)
+        if not foreign:
+            self.known_stat = file_stat(self.xlsx_file_path)
+        return result
+
+    def load_shop(self):
+        self.known_stat = file_stat(self.xlsx_file_path)
+        return load_shop_cached(self.xlsx_file_path, 'shop', 'admin')
+
+    def add_admin(self, admin_id):
+        self._own_write(
+            add_admin_to_excel, self.xlsx_file_path, 'admin', admin_id
+        )
+
+    def load_tariffs(self):
+        return load_sheet_rows(self.xlsx_file_path, SHIPPING_SHEET)
+
+    def save_stock(self, stock):
+        self._own_write(
+            save_stock_to_excel, self.xlsx_file_path, 'shop', stock
+        )
+
+    def add_transactions(self, rows):
+        self.rotate_transactions()
+        self._own_write(
+            add_transactions, self.xlsx_file_path, 'transactions', rows
+        )
+
+    def iter_transactions(self):
+        return iter_all_transaction_rows(
+            self.xlsx_file_path, 'transactions', self.archive_dir
+        )
+
+    def rotate_transactions(self):
+        """Раз в месяц переносит закрытые месяцы в архивные книги."""
+        today = datetime.date.today()
+        if self._rotated_month == (today.year, today.month):
+            return 0
+        moved = self._own_write(
+            rotate_transactions, self.xlsx_file_path, 'transactions',
+            self.archive_dir, today
+        )
+        self._rotated_month = (today.year, today.month)
+        if moved:
+            logger.info('В архив перенесено транзакций: %s', moved)
+        return moved
+
+    def export_xlsx(self):
+        return self.xlsx_file_path
+
+    def import_xlsx(self, xlsx_file_path):
+        """Подменяет книгу загруженной, сохраняя транзакции живой книги.
+
+        Лист транзакций загруженного файла заменяется листом из текущей
+        книги, после чего файл атомарно переименовывается в "shop.xlsx".
+        Файл должен лежать в том же каталоге, что и книга.
+        """
+        if os.path.exists(self.xlsx_file_path):
+            workbook = open_workbook(xlsx_file_path)
+            if 'transactions' in workbook.sheetnames:
+                workbook.remove(workbook['transactions'])
+            transaction_sheet = initiate_transactions_sheet(
+                workbook, 'transactions'
+            )
+            for row in iter_transaction_rows(
+                    self.xlsx_file_path, 'transactions'):
+                transaction_sheet.append(row)
+            save_workbook(workbook, xlsx_file_path)
+            workbook.close()
+        # Новый каталог бот собирает сам сразу после загрузки
+        self._own_write(os.replace, xlsx_file_path, self.xlsx_file_path)
+
+
+class SqliteStorage(Storage):
+    """Хранилище в базе SQLite в режиме WAL."""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS items (
+            key TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            title TEXT,
+            price REAL,
+            currency TEXT,
+            description TEXT,
+            category TEXT,
+            weight REAL,
+            stock INTEGER,
+            photo TEXT
+        );
+        CREATE INDEX IF NOT EXISTS items_position ON items (position);
+        CREATE TABLE IF NOT EXISTS shipping (
+            position INTEGER PRIMARY KEY,
+            country TEXT,
+            postcode_prefix TEXT,
+            max_weight REAL,
+            option TEXT,
+            price REAL,
+            currency TEXT
+        );
+        CREATE TABLE IF NOT EXISTS admins (
+            id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            price REAL,
+            currency TEXT,
+            name TEXT,
+            email TEXT,
+            phone_number TEXT,
+            shipping_address TEXT,
+            status TEXT,
+            datetime TEXT,
+            chat_id INTEGER,
+            telegram_payment_charge_id TEXT,
+            provider_payment_charge_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS transactions_title
+            ON transactions (title);
+    '''
+
+    def __init__(self, db_path=SQLITE_PATH, seed_xlsx_path='shop.xlsx'):
+        self.db_path = db_path
+        self.export_path = os.path.splitext(db_path)[0] + '.export.xlsx'
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            self._connection.executescript(self.SCHEMA)
+            self._add_missing_columns()
+            # Колонка появляется в старых базах только после миграции,
+            # поэтому индекс создаётся здесь, а не в SCHEMA. Уникальность
+            # не даёт записать оплату дважды, например если компакция
+            # журнала прервалась после записи пачки
+            self._connection.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS transactions_charge '
+                'ON transactions (telegram_payment_charge_id) '
+                'WHERE telegram_payment_charge_id IS NOT NULL'
+            )
+        if self._is_empty() and os.path.exists(seed_xlsx_path):
+            # Первый запуск на SQLite: переносим всё из текущей книги
+            self.import_xlsx(seed_xlsx_path, with_transactions=True)
+
+    def _add_missing_columns(self):
+        """Добавляет в таблицы колонки новых версий схемы."""
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {
+                row[1] for row in self._connection.execute(
+                    f'PRAGMA table_info({table})'
+                )
+            }
+            for column, column_type in columns.items():
+                if column not in existing:
+                    self._connection.execute(
+                        f'ALTER TABLE {table} ADD COLUMN {column} '
+                        f'{column_type}'
+                    )
+
+    def _is_empty(self):
+        with self._lock:
+            return not any(
+                self._connection.execute(
+                    f'SELECT 1 FROM {table} LIMIT 1'
+                ).fetchone()
+                for table in ('items', 'admins', 'transactions')
+            )
+
+    def load_shop(self):
+        with self._lock:
+            rows = self._connection.execute(SELECT_ITEMS).fetchall()
+            admins = [
+                row[0] for row in self._connection.execute(
+                    'SELECT id FROM admins ORDER BY rowid'
+                )
+            ]
+        items = {row[0]: build_item(row) for row in rows}
+        return items, admins
+
+    def load_tariffs(self):
+        with self._lock:
+            return [
+                list(row) for row in self._connection.execute(
+                    f'SELECT {", ".join(SHIPPING_COLUMNS)} FROM shipping '
+                    f'ORDER BY position'
+                )
+            ]
+
+    def save_stock(self, stock):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'UPDATE items SET stock = ? WHERE key = ?',
+                [(count, key) for key, count in stock.items()]
+            )
+
+    def add_admin(self, admin_id):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR IGNORE INTO admins (id) VALUES (?)', (admin_id,)
+            )
+
+    def add_transactions(self, rows):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                INSERT_TRANSACTION,
+                [
+                    # Строки старых версий короче: недостающие колонки
+                    # заполняем NULL
+                    (list(row) + [None] * len(TRANSACTION_COLUMNS))[
+                        :len(TRANSACTION_COLUMNS)
+                    ]
+                    for row in rows
+                ]
+            )
+
+    def iter_chat_ids(self):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT chat_id FROM transactions WHERE chat_id IS NOT NULL '
+                'GROUP BY chat_id ORDER BY MIN(id)'
+            ).fetchall()
+        return (row[0] for row in rows)
+
+    def iter_transactions(self):
+        with self._lock:
+            cursor = self._connection.execute(SELECT_TRANSACTIONS)
+            rows = cursor.fetchmany(1000)
+        while rows:
+            for row in rows:
+                yield list(row)
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+
+    def export_xlsx(self):
+        items, admins = self.load_shop()
+        workbook = Workbook(write_only=True)
+        admin_sheet = workbook.create_sheet('admin')
+        admin_sheet.append(['allowed_id'])
+        for admin_id in admins:
+            admin_sheet.append([admin_id])
+        shop_sheet = workbook.create_sheet('shop')
+        shop_sheet.append(SHOP_COLUMNS)
+        for key, item in items.items():
+            shop_sheet.append(item_row(key, item))
+        shipping_sheet = workbook.create_sheet(SHIPPING_SHEET)
+        shipping_sheet.append(SHIPPING_COLUMNS)
+        for row in self.load_tariffs():
+            shipping_sheet.append(row)
+        transaction_sheet = workbook.create_sheet('transactions')
+        transaction_sheet.append(TRANSACTION_COLUMNS)
+        for row in self.iter_transactions():
+            transaction_sheet.append(row)
+        tmp_path = self.export_path + '.tmp'
+        save_workbook(workbook, tmp_path)
+        os.replace(tmp_path, self.export_path)
+        return self.export_path
+
+    def import_xlsx(self, xlsx_file_path, with_transactions=False):
+        """Заменяет каталог, тарифы доставки и админов данными из книги.
+
+        Транзакции в базе главнее выгруженных в xlsx, поэтому из книги они
+        переносятся только при первичном заполнении базы.
+        """
+        items, admins = load_shop(xlsx_file_path)
+        tariffs = load_sheet_rows(xlsx_file_path, SHIPPING_SHEET)
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM shipping')
+            self._connection.executemany(
+                f'INSERT INTO shipping (position, '
+                f'{", ".join(SHIPPING_COLUMNS)}) VALUES '
+                f'({", ".join("?" * (len(SHIPPING_COLUMNS) + 1))})',
+                [
+                    [position] + (list(row) + [None] * len(SHIPPING_COLUMNS))[
+                        :len(SHIPPING_COLUMNS)
+                    ]
+                    for position, row in enumerate(tariffs)
+                ]
+            )
+            self._connection.execute('DELETE FROM items')
+            self._connection.executemany(
+                INSERT_ITEM,
+                [
+                    [position] + item_row(key, item)
+                    for position, (key, item) in enumerate(
+                        (items or dict()).items()
+                    )
+                ]
+            )
+            self._connection.execute('DELETE FROM admins')
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO admins (id) VALUES (?)',
+                [(admin_id,) for admin_id in admins or list()]
+            )
+        if with_transactions:
+            self.add_transactions(
+                iter_all_transaction_rows(
+                    xlsx_file_path, 'transactions', TRANSACTIONS_ARCHIVE_DIR
+                )
+            )
+
+
+def open_storage(backend=None, xlsx_file_path='shop.xlsx'):
+    """Хранилище, выбранное переменной окружения STORAGE_BACKEND."""
+    if (backend or STORAGE_BACKEND) == 'sqlite':
+        return SqliteStorage(SQLITE_PATH, seed_xlsx_path=xlsx_file_path)
+    return ExcelStorage(xlsx_file_path)
@@ -0,0 +1,89 @@
+"""Сверка потокового чтения каталога с чтением через openpyxl.
+
+Без аргументов собирает книгу с ячейками, на которых загрузчики уже
+расходились: формулы с пустым закэшированным значением <v/> (так их
+сохраняет openpyxl), пустые ячейки, числа и логические значения. С путями
+к книгам сверяет их. При расхождении скрипт завершается с кодом 1.
+
+Запуск из корня проекта:
+
+    python tools/check_loaders.py
+    python tools/check_loaders.py shop.xlsx
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+from openpyxl import Workbook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from xlsx_stream import load_shop  # noqa: E402
+
+
+def write_sample(path):
+    """Книга с формулами, пустыми и нечисловыми ячейками в каталоге."""
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    admin_sheet = workbook.create_sheet('admin')
+    admin_sheet.append(['allowed_id'])
+    admin_sheet.append([123456789])
+    admin_sheet.append(['=100+1'])
+    shop_sheet = workbook.create_sheet('shop')
+    shop_sheet.append(
+        ['named_id', 'title', 'price', 'currency', 'description', 'category',
+         'weight', 'stock', 'photo']
+    )
+    shop_sheet.append(
+        ['plain', 'Товар', 100, 'RUB', 'Описание', None, 1.5, 3, None]
+    )
+    shop_sheet.append(
+        ['formula', 'Товар с формулами', 250.5, 'RUB', '=B3&" "&D3',
+         '=UPPER("зима")', '=0.5*2', None, True]
+    )
+    shop_sheet.append(['short', 'Короткий ряд', 10, 'RUB'])
+    workbook.save(path)
+
+
+def compare(path):
+    """Расхождения загрузчиков на книге path."""
+    problems = list()
+    expected_items, expected_admins = load_shop(path, loader='openpyxl')
+    items, admins = load_shop(path, loader='stream')
+    if admins != expected_admins:
+        problems.append(f'админы: {admins!r} вместо {expected_admins!r}')
+    for key in expected_items.keys() | items.keys():
+        if items.get(key) != expected_items.get(key):
+            problems.append(
+                f'товар {key!r}: {items.get(key)!r} вместо '
+                f'{expected_items.get(key)!r}'
+            )
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='*')
+    args = parser.parse_args()
+    paths = args.paths
+    workdir = None
+    if not paths:
+        workdir = tempfile.TemporaryDirectory()
+        paths = [os.path.join(workdir.name, 'sample.xlsx')]
+        write_sample(paths[0])
+    failed = False
+    for path in paths:
+        problems = compare(path)
+        failed = failed or bool(problems)
+        print(f'{path}: {"расхождения" if problems else "совпадает"}')
+        for line in problems:
+            print('  ' + line)
+    if workdir is not None:
+        workdir.cleanup()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
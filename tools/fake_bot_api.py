@@ -0,0 +1,296 @@
+"""Локальная замена Telegram Bot API для ручных и нагрузочных проверок.
+
+Сервер принимает запросы вида /bot<token>/<method>, запоминает каждый
+вызов и отвечает правдоподобными данными: getMe отдаёт бота, методы
+send*/edit* отдают сообщение, остальные просто True. Бот направляется на
+сервер переменной окружения BOT_API_URL, например
+BOT_API_URL=http://127.0.0.1:8081.
+
+getUpdates отдаёт обновления, поставленные в очередь push_update (или
+файлом --updates), с long polling, как настоящий Bot API, поэтому бот
+в режиме polling обрабатывает их без webhook.
+
+Для проверки рассылки сервер умеет изображать флуд-контроль Telegram
+(ответ 429 с retry_after при превышении частоты sendMessage) и чаты, где
+пользователь заблокировал бота (ответ 403).
+
+Запуск из корня проекта:
+
+    python tools/fake_bot_api.py --port 8081
+    python tools/fake_bot_api.py --flood-rate 30 --blocked 111 222
+    python tools/fake_bot_api.py --updates tools/samples/start_show.jsonl
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_USER = {
+    'id': 1000000001,
+    'is_bot': True,
+    'first_name': 'Fake shop bot',
+    'username': 'fake_shop_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': True,
+}
+
+
+def parse_params(content_type, body):
+    """Параметры запроса: form-urlencoded, multipart или JSON."""
+    content_type = content_type or ''
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body
+        )
+        params = dict()
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                params[name] = f'<file {part.get_filename()}>'
+            else:
+                params[name] = part.get_content()
+        return params
+    return dict(parse_qsl(body.decode()))
+
+
+class FakeBotApi:
+    """HTTP сервер, отвечающий как Bot API и записывающий вызовы."""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.calls = list()
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        # Переопределённые ответы: метод -> функция(params) -> (код, тело)
+        self.overrides = dict()
+        # Функции listener(method, params), вызываемые на каждый вызов
+        self.listeners = list()
+        # Очередь обновлений для getUpdates
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._updates_ready = threading.Condition()
+        handler = self._handler_class()
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='fake-bot-api',
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def record(self, method, params):
+        with self._lock:
+            self.calls.append((time.perf_counter(), method, params))
+        for listener in self.listeners:
+            listener(method, params)
+
+    def push_update(self, update):
+        """Ставит обновление в очередь getUpdates и возвращает его update_id.
+
+        update_id назначается сервером по порядку.
+        """
+        with self._updates_ready:
+            update = dict(update, update_id=next(self._update_ids))
+            self._updates.append(update)
+            self._updates_ready.notify_all()
+        return update['update_id']
+
+    def next_updates(self, params):
+        """Ответ getUpdates: подтверждает offset и ждёт новые обновления."""
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self._updates_ready:
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._updates_ready.wait(remaining)
+            return list(itertools.islice(self._updates, limit))
+
+    def calls_of(self, method):
+        """Параметры всех вызовов метода в порядке поступления."""
+        with self._lock:
+            return [params for _, name, params in self.calls if name == method]
+
+    def message(self, params):
+        """Сообщение, которое Bot API вернул бы на send*/edit*."""
+        chat_id = params.get('chat_id') or 0
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+        if 'photo' in params:
+            # Загруженный файл получает новый file_id, а отправленный по
+            # file_id возвращается с тем же
+            file_id = str(params['photo'])
+            if file_id.startswith('<file'):
+                file_id = f'fake-photo-{message["message_id"]}'
+            message['photo'] = [{
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'width': 400,
+                'height': 400,
+            }]
+        return message
+
+    def result(self, method, params):
+        """Результат вызова метода по умолчанию."""
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self.next_updates(params)
+        if method.startswith('send') or method.startswith('edit'):
+            return self.message(params)
+        return True
+
+    def limit_rate(self, method, per_second, retry_after=1):
+        """Отвечает 429, если метод вызывают чаще per_second раз в секунду."""
+        recent = deque()
+        lock = threading.Lock()
+        fallback = self.overrides.get(method)
+
+        def override(params):
+            now = time.monotonic()
+            with lock:
+                while recent and now - recent[0] >= 1:
+                    recent.popleft()
+                if len(recent) >= per_second:
+                    return 429, {
+                        'ok': False,
+                        'error_code': 429,
+                        'description': (
+                            f'Too Many Requests: retry after {retry_after}'
+                        ),
+                        'parameters': {'retry_after': retry_after},
+                    }
+                recent.append(now)
+            if fallback:
+                return fallback(params)
+            return 200, {'ok': True, 'result': self.result(method, params)}
+
+        self.overrides[method] = override
+
+    def block_chats(self, chat_ids, method='sendMessage'):
+        """Отвечает 403 на отправку в чаты, заблокировавшие бота."""
+        blocked = {str(chat_id) for chat_id in chat_ids}
+        fallback = self.overrides.get(method)
+
+        def override(params):
+            if str(params.get('chat_id')) in blocked:
+                return 403, {
+                    'ok': False,
+                    'error_code': 403,
+                    'description': 'Forbidden: bot was blocked by the user',
+                }
+            if fallback:
+                return fallback(params)
+            return 200, {'ok': True, 'result': self.result(method, params)}
+
+        self.overrides[method] = override
+
+    def respond(self, method, params):
+        """Код ответа и тело JSON для вызова метода."""
+        override = self.overrides.get(method)
+        if override:
+            return override(params)
+        return 200, {'ok': True, 'result': self.result(method, params)}
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Соединения держатся открытыми, как у настоящего Bot API.
+            # Заголовки и тело уходят отдельными записями, поэтому без
+            # TCP_NODELAY ответ ждал бы подтверждения по алгоритму Нейгла
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                params = parse_params(self.headers.get('Content-Type'), body)
+                api.record(method, params)
+                status, payload = api.respond(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument(
+        '--flood-rate', type=int, default=0,
+        help='sendMessage в секунду, после которых отвечать 429'
+    )
+    parser.add_argument(
+        '--blocked', nargs='*', default=(),
+        help='айди чатов, заблокировавших бота'
+    )
+    parser.add_argument(
+        '--updates',
+        help='JSON Lines с обновлениями, которые отдать через getUpdates'
+    )
+    args = parser.parse_args()
+    api = FakeBotApi(args.host, args.port)
+    if args.updates:
+        with open(args.updates, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    api.push_update(json.loads(line))
+    if args.blocked:
+        api.block_chats(args.blocked)
+    if args.flood_rate:
+        api.limit_rate('sendMessage', args.flood_rate)
+    api.start()
+    print(f'Fake Bot API слушает {api.url}')
+    try:
+        while True:
+            time.sleep(5)
+            print(f'Вызовов: {len(api.calls)}')
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,550 @@
+"""Нагрузочный прогон бота: синтетические покупатели от /start до оплаты.
+
+Бот собирается shop_bot.build_application() и получает обновления через
+getUpdates локальной заглушки Bot API (fake_bot_api.py), как в режиме
+polling. Заглушка, SMTP сервер-приёмник и сами покупатели работают в
+отдельном процессе, чтобы не делить с ботом GIL и event loop.
+
+Каждый покупатель проходит сценарий /start -> "Показать товары" ->
+товар -> "Нет" (счёт без доставки) -> pre_checkout_query -> оплата.
+Задержка шага - время от постановки обновления в очередь getUpdates до
+ответного вызова Bot API (сообщения, счёта или answerPreCheckoutQuery).
+
+В процессе бота замеряется, насколько позже запланированного просыпается
+event loop. Задержки раскладываются по тому, шла ли в это время работа
+с книгой в потоке хранилища или отправка письма по SMTP.
+
+Запуск из корня проекта:
+
+    python tools/load_test.py --sessions 2000 --concurrency 200
+    python tools/load_test.py --sessions 500 --items 10000 \
+        --transactions 100000 --json load.json
+"""
+import argparse
+import asyncio
+import bisect
+import functools
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+from generate_shop import generate_shop  # noqa: E402
+
+STEPS = ('start', 'show', 'item', 'invoice', 'precheckout', 'payment')
+FIRST_CHAT_ID = 700000000
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """Минимальный диалог SMTP: принимает любое письмо."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost ESMTP sink')
+        for line in iter(self.rfile.readline, b''):
+            command = line[:4].upper()
+            if command in (b'HELO', b'EHLO'):
+                self.reply('250 localhost')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for data_line in iter(self.rfile.readline, b''):
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """SMTP сервер, который только считает полученные письма."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), SmtpHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+
+
+def session_updates(n, key, price):
+    """Шаги сценария покупателя: (шаг, чат или запрос ответа, обновление)."""
+    chat_id = FIRST_CHAT_ID + n
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'Покупатель {n}'}
+    chat = {'id': chat_id, 'type': 'private'}
+    now = int(time.time())
+
+    def message(**fields):
+        return dict(
+            {'message_id': 1, 'date': now, 'chat': chat, 'from': user},
+            **fields
+        )
+
+    def callback(step, data):
+        return {
+            'callback_query': {
+                'id': f'{n}-{step}',
+                'chat_instance': str(chat_id),
+                'from': user,
+                'data': data,
+                'message': message(text='...'),
+            }
+        }
+
+    query_id = f'pc-{n}'
+    return (
+        ('start', str(chat_id), {
+            'message': message(
+                text='/start',
+                entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}]
+            )
+        }),
+        ('show', str(chat_id), callback('show', 'show_items')),
+        ('item', str(chat_id), callback('item', key)),
+        ('invoice', str(chat_id), callback('invoice', f'{key} no_shipping')),
+        ('precheckout', query_id, {
+            'pre_checkout_query': {
+                'id': query_id,
+                'from': user,
+                'currency': 'RUB',
+                'total_amount': price,
+                'invoice_payload': key,
+            }
+        }),
+        ('payment', str(chat_id), {
+            'message': message(
+                successful_payment={
+                    'currency': 'RUB',
+                    'total_amount': price,
+                    'invoice_payload': key,
+                    'telegram_payment_charge_id': f'tg-{n}',
+                    'provider_payment_charge_id': f'provider-{n}',
+                    'order_info': {
+                        'name': f'Покупатель {n}',
+                        'email': f'buyer{n}@example.com',
+                        'phone_number': f'+7900{n:07d}',
+                    },
+                }
+            )
+        }),
+    )
+
+
+class SessionDriver:
+    """Покупатели, ждущие ответа бота на каждый свой шаг."""
+
+    def __init__(self, api, loop, timeout):
+        self.api = api
+        self.loop = loop
+        self.timeout = timeout
+        self.latencies = {step: list() for step in STEPS}
+        self.failures = Counter()
+        self.completed = 0
+        # чат или айди pre_checkout_query -> future ответа бота
+        self._waiters = dict()
+        self._lock = threading.Lock()
+        api.listeners.append(self.on_call)
+
+    def on_call(self, method, params):
+        """Вызов Bot API от бота. Выполняется в потоке HTTP сервера."""
+        if method == 'getUpdates':
+            return
+        target = params.get('pre_checkout_query_id') or params.get('chat_id')
+        with self._lock:
+            future = self._waiters.pop(str(target), None)
+        if future is not None:
+            self.loop.call_soon_threadsafe(
+                _resolve, future, time.perf_counter()
+            )
+
+    async def step(self, target, update):
+        """Отправляет обновление и возвращает задержку ответа или None."""
+        future = self.loop.create_future()
+        with self._lock:
+            self._waiters[target] = future
+        started = time.perf_counter()
+        self.api.push_update(update)
+        try:
+            answered = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._waiters.pop(target, None)
+            return None
+        return answered - started
+
+    async def session(self, n, key, price, think_time):
+        for step, target, update in session_updates(n, key, price):
+            latency = await self.step(target, update)
+            if latency is None:
+                self.failures[step] += 1
+                return
+            self.latencies[step].append(latency)
+            if think_time:
+                await asyncio.sleep(think_time)
+        self.completed += 1
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+async def drive(api, items, options):
+    """Прогоняет все сессии с ограничением числа одновременных."""
+    driver = SessionDriver(
+        api, asyncio.get_running_loop(), options['timeout']
+    )
+    rnd = random.Random(options['seed'])
+    semaphore = asyncio.Semaphore(options['concurrency'])
+
+    async def limited(n):
+        key, price = rnd.choice(items)
+        async with semaphore:
+            await driver.session(n, key, price, options['think_time'])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(n) for n in range(options['sessions'])))
+    return {
+        'elapsed': time.perf_counter() - started,
+        'completed': driver.completed,
+        'failures': dict(driver.failures),
+        'latencies': driver.latencies,
+    }
+
+
+def run_harness(conn):
+    """Процесс заглушки Bot API, SMTP приёмника и покупателей."""
+    api = FakeBotApi().start()
+    smtp = SmtpSink()
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+    conn.send((api.url, smtp.server_address[1]))
+    _, items, options = conn.recv()
+    conn.send(asyncio.run(drive(api, items, options)))
+    # Письма уходят после оплаты в фоне, поэтому считаем их, когда бот
+    # остановлен и очередь писем разобрана
+    conn.recv()
+    conn.send({
+        'emails': smtp.messages,
+        'calls': dict(Counter(method for _, method, _ in api.calls)),
+    })
+    api.stop()
+    smtp.shutdown()
+
+
+class LoopMonitor:
+    """Насколько позже запланированного просыпается event loop."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # (начало, конец, задержка) каждого замера
+        self.samples = list()
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            finished = time.perf_counter()
+            self.samples.append(
+                (started, finished, finished - started - self.interval)
+            )
+
+
+class WorkProbe:
+    """Интервалы работы с хранилищем и SMTP в их собственных потоках."""
+
+    def __init__(self):
+        self.intervals = {'excel': list(), 'smtp': list()}
+
+    def track(self, kind, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.intervals[kind].append((started, time.perf_counter()))
+        return wrapper
+
+    def union(self, kind):
+        """Объединение пересекающихся интервалов, по возрастанию начала."""
+        merged = list()
+        for start, end in sorted(self.intervals[kind]):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+
+def overlaps(union, starts, start, end):
+    """Пересекается ли [start, end] с объединением интервалов."""
+    idx = bisect.bisect_left(starts, end) - 1
+    return idx >= 0 and union[idx][1] > start
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def loop_blocking(monitor, probe, threshold):
+    """Задержки event loop по причинам: хранилище, SMTP, прочее."""
+    unions = {kind: probe.union(kind) for kind in probe.intervals}
+    starts = {
+        kind: [interval[0] for interval in union]
+        for kind, union in unions.items()
+    }
+    causes = {
+        cause: {'samples': 0, 'blocked_seconds': 0.0, 'max_ms': 0.0}
+        for cause in ('excel', 'smtp', 'other')
+    }
+    for start, end, lag in monitor.samples:
+        if lag < threshold:
+            continue
+        cause = 'other'
+        for kind in ('excel', 'smtp'):
+            if overlaps(unions[kind], starts[kind], start, end):
+                cause = kind
+                break
+        totals = causes[cause]
+        totals['samples'] += 1
+        totals['blocked_seconds'] += lag
+        totals['max_ms'] = max(totals['max_ms'], lag * 1000)
+    lags = [lag for _, _, lag in monitor.samples]
+    return {
+        'samples': len(lags),
+        'p50_ms': percentile(lags, 0.5) * 1000,
+        'p99_ms': percentile(lags, 0.99) * 1000,
+        'max_ms': max(lags, default=0) * 1000,
+        'by_cause': causes,
+        'work_seconds': {
+            kind: sum(end - start for start, end in intervals)
+            for kind, intervals in probe.intervals.items()
+        },
+        'work_count': {
+            kind: len(intervals)
+            for kind, intervals in probe.intervals.items()
+        },
+    }
+
+
+async def run_bot(shop_bot, conn, items, options):
+    """Запускает бота в режиме polling на время прогона покупателей."""
+    probe = WorkProbe()
+    shop_bot.EXCEL._execute = probe.track('excel', shop_bot.EXCEL._execute)
+    shop_bot.MAIL_QUEUE._send = probe.track(
+        'smtp', shop_bot.MAIL_QUEUE._send
+    )
+    app = shop_bot.build_application()
+    await app.initialize()
+    await shop_bot.on_startup(app)
+    await app.updater.start_polling(poll_interval=0, timeout=5)
+    await app.start()
+    monitor = LoopMonitor()
+    monitor_task = asyncio.create_task(monitor.run())
+    cpu_started = time.process_time()
+    conn.send(('go', items, options))
+    result = await asyncio.to_thread(conn.recv)
+    result['bot_cpu_seconds'] = time.process_time() - cpu_started
+    monitor_task.cancel()
+    await app.updater.stop()
+    await app.stop()
+    await shop_bot.on_shutdown(app)
+    await app.shutdown()
+    conn.send('stop')
+    result.update(await asyncio.to_thread(conn.recv))
+    result['loop'] = loop_blocking(
+        monitor, probe, options['block_threshold']
+    )
+    result['handlers'] = shop_bot.REGISTRY.summary()
+    return result
+
+
+def print_report(result, options):
+    elapsed = result['elapsed']
+    steps_done = sum(len(values) for values in result['latencies'].values())
+    print(
+        f'Сессий: {options["sessions"]}, завершено {result["completed"]}, '
+        f'одновременно до {options["concurrency"]}, за {elapsed:.2f} с'
+    )
+    if result['failures']:
+        print(f'Не дождались ответа на шаге: {result["failures"]}')
+    print(
+        f'Пропускная способность: {steps_done / elapsed:.1f} обновлений/с, '
+        f'{result["completed"] / elapsed:.1f} оплат/с'
+    )
+    # Если процесс бота занимал процессор почти всё время прогона,
+    # пропускная способность упирается в CPU, а не в ожидание
+    print(
+        f'Процессорное время бота: {result["bot_cpu_seconds"]:.2f} с '
+        f'({result["bot_cpu_seconds"] / elapsed:.0%} прогона, '
+        f'процессоров: {os.cpu_count()})'
+    )
+    print('Задержка ответа, мс:      p50      p95      p99      max')
+    all_latencies = list()
+    for step in STEPS:
+        values = result['latencies'][step]
+        all_latencies.extend(values)
+        print(f'  {step:<12}' + ''.join(
+            f'{value * 1000:9.1f}' for value in (
+                percentile(values, 0.5), percentile(values, 0.95),
+                percentile(values, 0.99), max(values, default=0)
+            )
+        ))
+    print(f'  {"всего":<12}' + ''.join(
+        f'{value * 1000:9.1f}' for value in (
+            percentile(all_latencies, 0.5), percentile(all_latencies, 0.95),
+            percentile(all_latencies, 0.99), max(all_latencies, default=0)
+        )
+    ))
+    loop = result['loop']
+    print(
+        f'Задержки event loop: p50 {loop["p50_ms"]:.1f} мс, '
+        f'p99 {loop["p99_ms"]:.1f} мс, max {loop["max_ms"]:.1f} мс'
+    )
+    for cause, title in (
+            ('excel', 'во время работы с хранилищем'),
+            ('smtp', 'во время отправки писем'),
+            ('other', 'в остальное время')):
+        totals = loop['by_cause'][cause]
+        print(
+            f'  {title}: заблокирован {totals["blocked_seconds"]:.3f} с '
+            f'({totals["samples"]} замеров, max {totals["max_ms"]:.1f} мс)'
+        )
+    print(
+        f'Работа в фоновых потоках: хранилище {loop["work_count"]["excel"]} '
+        f'команд за {loop["work_seconds"]["excel"]:.3f} с, SMTP '
+        f'{loop["work_count"]["smtp"]} писем за '
+        f'{loop["work_seconds"]["smtp"]:.3f} с'
+    )
+    print(f'Писем получено SMTP сервером: {result["emails"]}')
+    print(f'Вызовы Bot API: {result["calls"]}')
+    print('Метрики бота:')
+    for line in result['handlers']:
+        print(f'  {line}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument(
+        '--concurrency', type=int, default=100,
+        help='сколько покупателей проходят сценарий одновременно'
+    )
+    parser.add_argument(
+        '--concurrent-updates', type=int, default=64,
+        help='CONCURRENT_UPDATES бота'
+    )
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--transactions', type=int, default=0)
+    parser.add_argument(
+        '--storage', choices=('excel', 'sqlite'), default='excel'
+    )
+    parser.add_argument(
+        '--compact-interval', type=int, default=5,
+        help='JOURNAL_COMPACT_INTERVAL бота на время прогона'
+    )
+    parser.add_argument(
+        '--think-time', type=float, default=0,
+        help='пауза покупателя между шагами в секундах'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=30,
+        help='сколько ждать ответа бота на шаг'
+    )
+    parser.add_argument(
+        '--block-threshold', type=float, default=0.005,
+        help='задержка loop в секундах, которая считается блокировкой'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='куда сохранить результаты в JSON')
+    parser.add_argument(
+        '--keep', action='store_true',
+        help='не удалять рабочий каталог с книгой и журналом'
+    )
+    args = parser.parse_args()
+    options = {
+        'sessions': args.sessions,
+        'concurrency': args.concurrency,
+        'think_time': args.think_time,
+        'timeout': args.timeout,
+        'block_threshold': args.block_threshold,
+        'seed': args.seed,
+    }
+    workdir = tempfile.mkdtemp(prefix='shop-load-')
+    generate_shop(
+        os.path.join(workdir, 'shop.xlsx'), args.items, 1, args.transactions
+    )
+    # Процесс покупателей создаётся до импорта бота, чтобы не унаследовать
+    # его потоки и данные
+    parent_conn, child_conn = multiprocessing.Pipe()
+    harness = multiprocessing.get_context('fork').Process(
+        target=run_harness, args=(child_conn,), daemon=True
+    )
+    harness.start()
+    api_url, smtp_port = parent_conn.recv()
+    os.environ.update({
+        'BOT_TOKEN': '123456:load-test',
+        'PROVIDER_TOKEN': 'load-test',
+        'BOT_API_URL': api_url,
+        'BOT_MODE': 'polling',
+        'CONCURRENT_UPDATES': str(args.concurrent_updates),
+        'STORAGE_BACKEND': args.storage,
+        'JOURNAL_COMPACT_INTERVAL': str(args.compact_interval),
+        'METRICS_PORT': '0',
+        'CATALOG_WATCH_INTERVAL': '0',
+        'SMTP_HOST': '127.0.0.1',
+        'SMTP_PORT': str(smtp_port),
+        'SMTP_SSL': 'false',
+        'YANDEX_MAIL_PASSWORD': '',
+        'MAIL_FROM': 'shop@example.com',
+    })
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        shop_bot = importlib.import_module('shop_bot')
+        items = [
+            (key, item.price)
+            for key, item in shop_bot.CATALOG.items.items()
+        ]
+        result = asyncio.run(run_bot(shop_bot, parent_conn, items, options))
+    finally:
+        os.chdir(cwd)
+        harness.join(timeout=5)
+        if args.keep:
+            print(f'Рабочий каталог: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(result, options)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(
+                dict(result, options=options), file, ensure_ascii=False,
+                indent=2
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Отправка записанных обновлений Telegram на webhook бота.
+
+Файл с обновлениями - JSON список или JSON Lines, по одному Update на
+строку. Запросы отправляются параллельно с заголовком секретного токена,
+как это делает Telegram.
+
+Запуск из корня проекта (бот запущен с BOT_MODE=webhook):
+
+    python tools/post_updates.py updates.jsonl \
+        --url http://127.0.0.1:8443/telegram --secret <WEBHOOK_SECRET>
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import httpx
+
+
+def read_updates(path):
+    """Обновления из JSON списка или JSON Lines."""
+    with open(path, encoding='utf-8') as file:
+        content = file.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+async def post_updates(updates, url, secret=None, concurrency=10):
+    """POST каждого обновления, возвращает счётчик кодов ответа."""
+    headers = dict()
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(timeout=30) as client:
+
+        async def post(update):
+            async with semaphore:
+                response = await client.post(url, json=update, headers=headers)
+                statuses[response.status_code] += 1
+
+        await asyncio.gather(*(post(update) for update in updates))
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='сколько раз повторить набор, update_id сдвигается'
+    )
+    args = parser.parse_args()
+    updates = read_updates(args.path)
+    batch = list()
+    for round_idx in range(args.repeat):
+        for update in updates:
+            update = dict(update)
+            update['update_id'] = (
+                update.get('update_id', 0) + round_idx * len(updates)
+            )
+            batch.append(update)
+    started = time.perf_counter()
+    statuses = asyncio.run(
+        post_updates(batch, args.url, args.secret, args.concurrency)
+    )
+    elapsed = time.perf_counter() - started
+    print(f'Отправлено {len(batch)} обновлений за {elapsed:.2f} с')
+    for status, count in sorted(statuses.items()):
+        print(f'  HTTP {status}: {count}')
+
+
+if __name__ == '__main__':
+    main()
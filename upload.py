@@ -0,0 +1,297 @@
+"""Проверка загруженной администратором книги перед заменой каталога.
+
+Файл сначала скачивается во временный файл рядом с "shop.xlsx", затем
+разбирается и проверяется в отдельном процессе, чтобы большая книга не
+блокировала бота. В хранилище попадает только книга, прошедшая проверку,
+а сообщение администратору перечисляет добавленные, удалённые и
+изменённые товары.
+"""
+import asyncio
+import multiprocessing
+import os
+import re
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+
+from catalog import is_navigation_data
+from photos import photo_path
+from shipping import SHIPPING_COLUMNS, SHIPPING_SHEET
+from xlsx_parser import build_item
+
+# Ограничения Bot API: заголовок счёта до 32 символов, описание до 255
+# (к нему добавляется пометка о доставке), callback_data до 64 байт
+# (к ключу добавляется " need_shipping")
+MAX_TITLE_LENGTH = 32
+MAX_DESCRIPTION_LENGTH = 255 - len(' (без доставки)')
+MAX_KEY_BYTES = 64 - len(' need_shipping')
+CURRENCY_CODE = re.compile(r'[A-Z]{3}')
+# callback_data кнопок бота, с которыми ключ товара нельзя перепутать:
+# callback_button разбирает "<ключ> need_shipping" по пробелу и ищет в
+# данных эти пометки
+RESERVED_CALLBACK_DATA = ('show_items',)
+SHIPPING_MARKS = ('need_shipping', 'no_shipping')
+# Сколько ошибок показывать администратору
+MAX_ERRORS = 20
+
+_POOL = None
+
+
+def staging_path(xlsx_file_path):
+    """Уникальный временный файл в каталоге книги для атомарной замены."""
+    directory = os.path.dirname(os.path.abspath(xlsx_file_path))
+    name, extension = os.path.splitext(os.path.basename(xlsx_file_path))
+    # openpyxl открывает файлы только с расширением xlsx
+    handle, path = tempfile.mkstemp(
+        dir=directory, prefix=f'{name}.upload.', suffix=extension
+    )
+    os.close(handle)
+    return path
+
+
+def row_errors(row_number, row, seen_keys):
+    """Ошибки одного ряда листа товаров."""
+    errors = list()
+    key, title, price, currency, description, _, weight, stock, photo = (
+        list(row) + [None] * 9
+    )[:9]
+    if not isinstance(key, str) or len(key.encode()) > MAX_KEY_BYTES:
+        errors.append(
+            f'ряд {row_number}: ключ товара должен быть строкой не длиннее '
+            f'{MAX_KEY_BYTES} байт'
+        )
+    elif key.split() != [key]:
+        errors.append(
+            f'ряд {row_number}: ключ товара не должен содержать пробелов'
+        )
+    elif (
+            key in RESERVED_CALLBACK_DATA
+            or is_navigation_data(key)
+            or any(mark in key for mark in SHIPPING_MARKS)
+    ):
+        errors.append(
+            f'ряд {row_number}: ключ "{key}" совпадает со служебными данными '
+            f'кнопок бота'
+        )
+    elif key in seen_keys:
+        errors.append(f'ряд {row_number}: ключ "{key}" уже встречался')
+    if not title or len(str(title)) > MAX_TITLE_LENGTH:
+        errors.append(
+            f'ряд {row_number}: название должно быть от 1 до '
+            f'{MAX_TITLE_LENGTH} символов'
+        )
+    if (
+            isinstance(price, bool)
+            or not isinstance(price, (int, float))
+            or price <= 0
+    ):
+        errors.append(
+            f'ряд {row_number}: цена должна быть положительным числом'
+        )
+    if not isinstance(currency, str) or not CURRENCY_CODE.fullmatch(currency):
+        errors.append(
+            f'ряд {row_number}: валюта должна быть трёхбуквенным кодом, '
+            f'например RUB'
+        )
+    if not description or len(str(description)) > MAX_DESCRIPTION_LENGTH:
+        errors.append(
+            f'ряд {row_number}: описание должно быть от 1 до '
+            f'{MAX_DESCRIPTION_LENGTH} символов'
+        )
+    if weight is not None and (
+            isinstance(weight, bool)
+            or not isinstance(weight, (int, float))
+            or weight < 0
+    ):
+        errors.append(
+            f'ряд {row_number}: вес должен быть неотрицательным числом'
+        )
+    if stock is not None and (
+            isinstance(stock, bool)
+            or not isinstance(stock, (int, float))
+            or stock < 0
+            or stock != int(stock)
+    ):
+        errors.append(
+            f'ряд {row_number}: остаток должен быть целым неотрицательным '
+            f'числом'
+        )
+    # Только имя файла: путь вне каталога фотографий не принимается
+    if photo is not None and (
+            not isinstance(photo, str)
+            or os.path.basename(photo) != photo
+            or not os.path.isfile(photo_path(photo))
+    ):
+        errors.append(
+            f'ряд {row_number}: нет файла фотографии "{photo}" в каталоге '
+            f'фотографий'
+        )
+    return errors
+
+
+def tariff_errors(row_number, row):
+    """Ошибки одного ряда листа тарифов доставки."""
+    errors = list()
+    country, _, max_weight, option, price, currency = (
+        list(row) + [None] * len(SHIPPING_COLUMNS)
+    )[:len(SHIPPING_COLUMNS)]
+    where = f'лист {SHIPPING_SHEET}, ряд {row_number}'
+    if country not in (None, '', '*') and (
+            not isinstance(country, str) or len(country.strip()) != 2):
+        errors.append(f'{where}: код страны должен быть из двух букв')
+    if max_weight is not None and (
+            isinstance(max_weight, bool)
+            or not isinstance(max_weight, (int, float))
+            or max_weight <= 0
+    ):
+        errors.append(f'{where}: max_weight должен быть положительным')
+    if not option:
+        errors.append(f'{where}: не указан способ доставки')
+    if (
+            isinstance(price, bool)
+            or not isinstance(price, (int, float))
+            or price < 0
+    ):
+        errors.append(f'{where}: цена должна быть неотрицательным числом')
+    if currency and (
+            not isinstance(currency, str)
+            or not CURRENCY_CODE.fullmatch(currency)):
+        errors.append(f'{where}: валюта должна быть трёхбуквенным кодом')
+    return errors
+
+
+def validate_upload(xlsx_file_path, items_sheet='shop', admins_sheet='admin'):
+    """Разбирает и проверяет книгу. Выполняется в отдельном процессе.
+
+    Возвращает (товары, айди админов, тарифы доставки, ошибки). Если
+    ошибки есть, всё, кроме них, - None. Лист тарифов необязателен.
+    """
+    try:
+        # Не open_workbook: замер времени берёт блокировку метрик, которую
+        # в момент fork мог держать другой поток бота, и процесс проверки
+        # завис бы на ней навсегда
+        workbook = load_workbook(xlsx_file_path, read_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError, OSError):
+        return (
+            None, None, None, ['файл повреждён или не является книгой xlsx']
+        )
+    errors = list()
+    items = dict()
+    admins = list()
+    tariffs = list()
+    try:
+        for sheet in (items_sheet, admins_sheet):
+            if sheet not in workbook.sheetnames:
+                errors.append(f'нет листа "{sheet}"')
+        if errors:
+            return None, None, None, errors
+        for row_number, row in enumerate(
+                workbook[items_sheet].iter_rows(min_row=2, values_only=True),
+                start=2):
+            if not row or not row[0]:
+                continue
+            problems = row_errors(row_number, row, items)
+            if problems:
+                errors.extend(problems)
+                if len(errors) >= MAX_ERRORS:
+                    break
+                continue
+            items[row[0]] = build_item((list(row) + [None] * 5))
+        for row_number, row in enumerate(
+                workbook[admins_sheet].iter_rows(min_row=2, values_only=True),
+                start=2):
+            if not row or not row[0]:
+                continue
+            if isinstance(row[0], bool) or not isinstance(row[0], int):
+                errors.append(
+                    f'лист {admins_sheet}, ряд {row_number}: айди админа '
+                    f'должен быть числом'
+                )
+                continue
+            admins.append(row[0])
+        if SHIPPING_SHEET in workbook.sheetnames:
+            for row_number, row in enumerate(
+                    workbook[SHIPPING_SHEET].iter_rows(
+                        min_row=2, max_col=len(SHIPPING_COLUMNS),
+                        values_only=True),
+                    start=2):
+                if not row or all(value is None for value in row):
+                    continue
+                problems = tariff_errors(row_number, row)
+                if problems:
+                    errors.extend(problems)
+                    if len(errors) >= MAX_ERRORS:
+                        break
+                    continue
+                tariffs.append(list(row))
+    finally:
+        workbook.close()
+    if not items and not errors:
+        errors.append('в каталоге нет ни одного товара')
+    if errors:
+        return None, None, None, errors[:MAX_ERRORS]
+    return items, admins, tariffs, list()
+
+
+def process_pool():
+    """Пул из одного процесса для проверки загрузок.
+
+    Процесс создаётся через fork: при spawn дочерний процесс заново
+    импортировал бы модуль бота вместе с загрузкой данных магазина. Поэтому
+    validate_upload не берёт блокировок, которые в момент fork мог держать
+    другой поток бота (хранилища или asyncio.to_thread).
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context('fork')
+        )
+    return _POOL
+
+
+async def run_validation(xlsx_file_path):
+    """Проверяет книгу в отдельном процессе, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        process_pool(), validate_upload, xlsx_file_path
+    )
+
+
+def shutdown_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+
+def catalog_diff(old_items, new_items):
+    """Ключи добавленных, удалённых и изменённых товаров."""
+    added = [key for key in new_items if key not in old_items]
+    removed = [key for key in old_items if key not in new_items]
+    changed = [
+        key for key, item in new_items.items()
+        if key in old_items and old_items[key] != item
+    ]
+    return added, removed, changed
+
+
+def format_diff(old_items, new_items, limit=10):
+    """Текст для администратора с изменениями каталога."""
+    added, removed, changed = catalog_diff(old_items, new_items)
+    if not (added or removed or changed):
+        return 'Каталог не изменился.'
+    lines = list()
+    for caption, keys, items in (
+            ('Добавлено', added, new_items),
+            ('Удалено', removed, old_items),
+            ('Изменено', changed, new_items)):
+        if not keys:
+            continue
+        lines.append(f'{caption}: {len(keys)}')
+        lines.extend(f'• {items[key].title}' for key in keys[:limit])
+        if len(keys) > limit:
+            lines.append(f'и ещё {len(keys) - limit}')
+    return '\n'.join(lines)
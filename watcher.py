@@ -0,0 +1,96 @@
+"""Фоновое отслеживание изменений книги каталога.
+
+Раз в CATALOG_WATCH_INTERVAL секунд сравниваются время изменения и
+размер "shop.xlsx". Когда они поменялись, наблюдатель ждёт, пока файл
+перестанет меняться в течение CATALOG_WATCH_DEBOUNCE секунд (редактор
+или копирование могут писать его в несколько приёмов), и сверяет sha256
+содержимого. Только если содержимое действительно другое, вызывается
+перезагрузка каталога.
+
+Собственные записи бота в книгу (перенос журнала оплат, остатки, /add,
+ротация транзакций) меняют файл, но не каталог. Хранилище запоминает
+stat книги после таких записей (known_stat), и файл с этим stat не
+перечитывается.
+"""
+import asyncio
+import logging
+import os
+
+from snapshot import file_digest
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять файл, 0 - не следить за ним
+WATCH_INTERVAL = float(os.getenv('CATALOG_WATCH_INTERVAL', 5))
+# Сколько файл должен не меняться, прежде чем его перечитать
+WATCH_DEBOUNCE = float(os.getenv('CATALOG_WATCH_DEBOUNCE', 2))
+
+
+def file_stat(path):
+    """Время изменения и размер файла или None, если файла нет."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class CatalogWatcher:
+    """Следит за файлом и вызывает корутину reload() при его изменении."""
+
+    def __init__(self, path, reload, interval=WATCH_INTERVAL,
+                 debounce=WATCH_DEBOUNCE, known_stat=None):
+        self.path = path
+        self.reload = reload
+        # Функция, возвращающая stat файла, уже учтённый ботом
+        self.known_stat = known_stat
+        self.interval = interval
+        self.debounce = debounce
+        self._stat = file_stat(path)
+        self._digest = None
+
+    async def _digest_now(self):
+        if not os.path.exists(self.path):
+            return None
+        return await asyncio.to_thread(file_digest, self.path)
+
+    async def _settled_stat(self, stat):
+        """Ждёт, пока файл перестанет меняться, и возвращает его stat."""
+        while True:
+            await asyncio.sleep(self.debounce)
+            latest = file_stat(self.path)
+            if latest == stat:
+                return stat
+            stat = latest
+
+    async def check(self):
+        """Одна проверка файла. Возвращает True, если вызвана reload()."""
+        stat = file_stat(self.path)
+        if stat is None or stat == self._stat:
+            return False
+        stat = await self._settled_stat(stat)
+        self._stat = stat
+        if stat is None:
+            return False
+        if self.known_stat is not None and stat == self.known_stat():
+            # Файл записал сам бот
+            return False
+        digest = await self._digest_now()
+        if digest == self._digest:
+            # Файл пересохранён без изменений
+            return False
+        self._digest = digest
+        await self.reload()
+        return True
+
+    async def run(self):
+        """Цикл наблюдения до отмены задачи."""
+        self._digest = await self._digest_now()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                # Битый файл не должен останавливать наблюдение: каталог
+                # остаётся прежним до следующего изменения
+                logger.exception('Не удалось перечитать каталог')
@@ -1,9 +1,38 @@
 """Модуль с утилитами для работы с таблицами эксель."""
+import datetime
+import glob
 import os
+import re
+from typing import NamedTuple, Optional
 
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
 from telegram import LabeledPrice
 
+from metrics import timed
+
+# Формат, в котором бот записывает дату и время транзакции
+TRANSACTION_DATETIME_FORMAT = '%d-%m-%y %H:%M'
+
+# Колонки листа транзакций. chat_id - чат покупателя для рассылок,
+# айди платежа в Telegram и у провайдера - для защиты от повторов и сверки
+TRANSACTION_COLUMNS = (
+    'title', 'price', 'currency', 'name', 'email', 'phone_number',
+    'shipping_address', 'status', 'datetime', 'chat_id',
+    'telegram_payment_charge_id', 'provider_payment_charge_id'
+)
+# Колонка айди оплаты в Telegram, по которой отсекаются повторы
+CHARGE_COLUMN = TRANSACTION_COLUMNS.index('telegram_payment_charge_id')
+
+# Колонки листа товаров
+SHOP_COLUMNS = (
+    'named_id', 'title', 'price', 'currency', 'description', 'category',
+    'weight', 'stock', 'photo'
+)
+
+# Архивная книга транзакций закрытого месяца: transactions-2024-01.xlsx
+ARCHIVE_NAME = 'transactions-{:04d}-{:02d}.xlsx'
+ARCHIVE_PATTERN = re.compile(r'transactions-(\d{4})-(\d{2})\.xlsx$')
+
 
 def get_string_shipping_address(shipping_address):
     """Строка адреса доставки из объекта телеграм."""
@@ -20,20 +49,83 @@ def get_string_shipping_address(shipping_address):
     return ''
 
 
+def open_workbook(xlsx_file_path, read_only=False):
+    """load_workbook с замером времени загрузки книги."""
+    mode = 'read_only' if read_only else 'full'
+    with timed('excel_load_seconds', mode=mode):
+        return load_workbook(xlsx_file_path, read_only=read_only)
+
+
+def save_workbook(workbook, xlsx_file_path):
+    """Сохранение книги с замером времени."""
+    with timed('excel_save_seconds'):
+        workbook.save(xlsx_file_path)
+
+
+def read_file_bytes(file_path):
+    """Содержимое файла целиком, например для отправки документом."""
+    with open(file_path, 'rb') as file:
+        return file.read()
+
+
+class Item(NamedTuple):
+    """Неизменяемая запись товара каталога.
+
+    Цена хранится в минимальных единицах валюты (копейках), а объект
+    LabeledPrice создаётся только при отправке счёта.
+    """
+
+    title: str
+    price: int
+    currency: str
+    description: str
+    category: Optional[str] = None
+    # Вес в килограммах для расчёта доставки (колонка G)
+    weight: Optional[float] = None
+    # Остаток на складе (колонка H), None - количество не ограничено
+    stock: Optional[int] = None
+    # Имя файла картинки в каталоге фотографий (колонка I)
+    photo: Optional[str] = None
+
+    def labeled_prices(self):
+        """Список цен для счёта Telegram."""
+        return [LabeledPrice(self.title, self.price)]
+
+    def major_price(self):
+        """Цена в основных единицах валюты, как в колонке C листа товаров."""
+        if self.price % 100:
+            return self.price / 100
+        return self.price // 100
+
+
+def item_row(key, item):
+    """Ряд листа товаров по записи товара, обратное к build_item."""
+    return [key, item.title, item.major_price()] + list(item[2:])
+
+
+def build_item(values):
+    """Характеристики товара из значений ряда листа товаров."""
+    return Item(
+        title=values[1],
+        price=round(values[2] * 100),
+        currency=values[3],
+        description=values[4],
+        category=values[5] if len(values) > 5 else None,
+        weight=values[6] if len(values) > 6 else None,
+        stock=values[7] if len(values) > 7 else None,
+        photo=values[8] if len(values) > 8 else None
+    )
+
+
 def collect_items(xlsx_file_path, sheet_name):
     """Сбор данных товаров из таблицы эксель и размещение их в памяти."""
     items = dict()
     if os.path.exists(path=xlsx_file_path):
-        workbook = load_workbook(xlsx_file_path, read_only=True)
+        workbook = open_workbook(xlsx_file_path, read_only=True)
         shop_sheet = workbook[sheet_name]
-        for row in shop_sheet.iter_rows(min_row=2):
-            if row[0].value:
-                items[row[0].value] = {
-                    'prices': [LabeledPrice(row[1].value, row[2].value * 100)],
-                    'title': row[1].value,
-                    'description': row[4].value,
-                    'currency': row[3].value
-                }
+        for row in shop_sheet.iter_rows(min_row=2, values_only=True):
+            if row and row[0]:
+                items[row[0]] = build_item(row)
         workbook.close()
         return items
 
@@ -42,11 +134,11 @@ def collect_admins_id(xlsx_file_path, sheet_name):
     """Сбор данных айди админов из таблицы эксель и размещение их в памяти."""
     ids = list()
     if os.path.exists(path=xlsx_file_path):
-        workbook = load_workbook(xlsx_file_path, read_only=True)
+        workbook = open_workbook(xlsx_file_path, read_only=True)
         admin_sheet = workbook[sheet_name]
-        for row in admin_sheet.iter_rows(min_row=2):
-            if row[0].value:
-                ids.append(row[0].value)
+        for row in admin_sheet.iter_rows(min_row=2, values_only=True):
+            if row and row[0]:
+                ids.append(row[0])
         workbook.close()
         return ids
 
@@ -54,96 +146,270 @@ def collect_admins_id(xlsx_file_path, sheet_name):
 def add_admin_to_excel(xlsx_file_path, sheet_name, admin_id):
     """Добавление в таблицу эксель данных нового админа."""
     if os.path.exists(path=xlsx_file_path):
-        workbook = load_workbook(xlsx_file_path)
+        workbook = open_workbook(xlsx_file_path)
         admin_sheet = workbook[sheet_name]
         max_row = admin_sheet.max_row
         coord = 'A' + str(max_row + 1)
         admin_sheet[coord] = admin_id
-        workbook.save(xlsx_file_path)
+        save_workbook(workbook, xlsx_file_path)
         workbook.close()
 
 
+def save_stock_to_excel(xlsx_file_path, sheet_name, stock):
+    """Запись остатков {ключ: количество} в колонку stock листа товаров.
+
+    Все изменённые остатки записываются за одно сохранение книги.
+    """
+    if not stock or not os.path.exists(path=xlsx_file_path):
+        return
+    column = SHOP_COLUMNS.index('stock') + 1
+    workbook = open_workbook(xlsx_file_path)
+    shop_sheet = workbook[sheet_name]
+    if shop_sheet.cell(1, column).value is None:
+        shop_sheet.cell(1, column, SHOP_COLUMNS[column - 1])
+    for row in shop_sheet.iter_rows(min_row=2, max_col=1):
+        key = row[0].value
+        if key in stock:
+            shop_sheet.cell(row[0].row, column, stock[key])
+    save_workbook(workbook, xlsx_file_path)
+    workbook.close()
+
+
 def delete_unfilled_rows(sheet):
-    """Утилита для удаления рядов таблицы."""
-    cur_rows = sheet.iter_rows(min_row=2, max_row=sheet.max_row, max_col=9)
-    idx = list()
-    for i in cur_rows:
-        if i[0].value:
+    """Удаление пустых рядов таблицы за один проход.
+
+    Заполненные ряды сдвигаются вверх на место пустых, а освободившийся
+    хвост листа удаляется одним вызовом delete_rows.
+    """
+    max_row = sheet.max_row
+    write_row = 2
+    for row in sheet.iter_rows(min_row=2, max_row=max_row):
+        if not row[0].value:
             continue
-        idx.append(i[0].row)
-    if idx:
-        for i in range(len(idx)):
-            sheet.delete_rows(idx[i] - i, 1)
-        return sheet
+        if row[0].row != write_row:
+            # Присваиваем и пустые значения: sheet.cell(ряд, колонка, None)
+            # оставил бы в ячейке значение сдвинутого ранее ряда
+            for cell in row:
+                sheet.cell(write_row, cell.column).value = cell.value
+        write_row += 1
+    if write_row <= max_row:
+        sheet.delete_rows(write_row, max_row - write_row + 1)
     return sheet
 
 
 def initiate_transactions_sheet(workbook, sheet_name):
     """Инициализация рабочей таблицы для транзакций."""
-    first_row = {
-        'A1': 'title',
-        'B1': 'price',
-        'C1': 'currency',
-        'D1': 'name',
-        'E1': 'email',
-        'F1': 'phone_number',
-        'G1': 'shipping_address',
-        'H1': 'status',
-        'I1': 'datetime'
-    }
     workbook.create_sheet(sheet_name)
     transaction_sheet = workbook[sheet_name]
-    for cell in first_row:
-        transaction_sheet[cell] = first_row.get(cell)
+    fill_transaction_headers(transaction_sheet)
     return transaction_sheet
 
 
-def add_transaction(xlsx_file_path, sheet_name, **kwargs):
-    """Создание записи в таблтице эксель о начале транзакции."""
-    if os.path.exists(path=xlsx_file_path):
-        workbook = load_workbook(xlsx_file_path)
+def fill_transaction_headers(transaction_sheet):
+    """Дописывает заголовки колонок, которых нет в старых листах."""
+    for column, header in enumerate(TRANSACTION_COLUMNS, start=1):
+        if transaction_sheet.cell(1, column).value is None:
+            transaction_sheet.cell(1, column, header)
+
+
+def build_transaction_row(**kwargs):
+    """Строка таблицы транзакций в порядке колонок A-L."""
+    shipping_address = get_string_shipping_address(
+        kwargs.get('shipping_address')
+    )
+    return [
+        kwargs.get('title'),
+        kwargs.get('price'),
+        kwargs.get('currency'),
+        kwargs.get('name'),
+        kwargs.get('email'),
+        kwargs.get('phone_number'),
+        shipping_address,
+        kwargs.get('status'),
+        kwargs.get('datetime'),
+        kwargs.get('chat_id'),
+        kwargs.get('telegram_payment_charge_id'),
+        kwargs.get('provider_payment_charge_id')
+    ]
+
+
+def add_transactions(xlsx_file_path, sheet_name, rows):
+    """Запись пачки транзакций в таблицу эксель за одно сохранение."""
+    if rows and os.path.exists(path=xlsx_file_path):
+        workbook = open_workbook(xlsx_file_path)
         if sheet_name not in workbook.sheetnames:
             initiate_transactions_sheet(workbook, sheet_name)
         transaction_sheet = delete_unfilled_rows(workbook[sheet_name])
-        cur_row_string = str(transaction_sheet.max_row + 1)
-        shipping_address = get_string_shipping_address(
-            kwargs.get('shipping_address')
-        )
-        zipped_data = dict(
-            zip(
-                ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I'),  # ячейки
-                [
-                    kwargs.get('title'),
-                    kwargs.get('price'),
-                    kwargs.get('currency'),
-                    kwargs.get('name'),
-                    kwargs.get('email'),
-                    kwargs.get('phone_number'),
-                    shipping_address,
-                    kwargs.get('status'),
-                    kwargs.get('datetime')
-                ]
+        fill_transaction_headers(transaction_sheet)
+        # Оплаты, которые уже есть на листе: пачка журнала могла попасть в
+        # книгу перед падением посреди компакции
+        stored = {
+            charge_id for (charge_id,) in transaction_sheet.iter_rows(
+                min_row=2, min_col=CHARGE_COLUMN + 1,
+                max_col=CHARGE_COLUMN + 1, values_only=True)
+            if charge_id
+        }
+        cur_row = transaction_sheet.max_row
+        for row in rows:
+            charge_id = (
+                row[CHARGE_COLUMN] if len(row) > CHARGE_COLUMN else None
             )
-        )
-        for i in zipped_data:
-            transaction_sheet[i + cur_row_string] = zipped_data.get(i)
-        workbook.save(xlsx_file_path)
+            if charge_id:
+                if charge_id in stored:
+                    continue
+                stored.add(charge_id)
+            cur_row += 1
+            for column, value in enumerate(row, start=1):
+                transaction_sheet.cell(cur_row, column, value)
+        save_workbook(workbook, xlsx_file_path)
+        workbook.close()
+
+
+def add_transaction(xlsx_file_path, sheet_name, **kwargs):
+    """Создание записи в таблтице эксель о начале транзакции."""
+    add_transactions(
+        xlsx_file_path, sheet_name, [build_transaction_row(**kwargs)]
+    )
+
+
+def parse_transaction_date(value):
+    """Дата транзакции из ячейки datetime или None, если её не разобрать."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.strptime(
+                value.strip(), TRANSACTION_DATETIME_FORMAT
+            ).date()
+        except ValueError:
+            return None
+    return None
+
+
+def iter_transaction_rows(xlsx_file_path, sheet_name='transactions'):
+    """Построчное чтение листа транзакций без загрузки книги в память."""
+    if not os.path.exists(path=xlsx_file_path):
+        return
+    workbook = open_workbook(xlsx_file_path, read_only=True)
+    try:
+        if sheet_name not in workbook.sheetnames:
+            return
+        for row in workbook[sheet_name].iter_rows(
+                min_row=2, max_col=len(TRANSACTION_COLUMNS),
+                values_only=True):
+            if row and row[0]:
+                yield list(row)
+    finally:
         workbook.close()
 
 
-def calculate_total_marge(xlsx_file_path, period=1, total=False):
-    """Считает выручку за период или суммурную."""
-    if total:
-        if os.path.exists(path=xlsx_file_path):
-            workbook = load_workbook(xlsx_file_path)
-            if 'transactions' in workbook.sheetnames:
-                sheet = workbook['transactions']
-                max_row = sheet.max_row
-                cur_amount = 0
-                for price in sheet.iter_rows(
-                        max_row=max_row, min_row=2, max_col=2, min_col=2,
-                        values_only=True):
-                    if price[0]:
-                        cur_amount += price[0]
-                return cur_amount
-            return 0
\ No newline at end of file
+def archive_months(archive_dir):
+    """Пути архивных книг по месяцам (год, месяц) в порядке времени."""
+    archives = dict()
+    for path in glob.glob(os.path.join(archive_dir, 'transactions-*.xlsx')):
+        match = ARCHIVE_PATTERN.search(os.path.basename(path))
+        if match:
+            archives[(int(match.group(1)), int(match.group(2)))] = path
+    return dict(sorted(archives.items()))
+
+
+def iter_all_transaction_rows(xlsx_file_path, sheet_name='transactions',
+                              archive_dir=None, since=None):
+    """Транзакции из архивов и живого листа в порядке времени.
+
+    Если задана дата since, архивы месяцев до неё не открываются.
+    """
+    if archive_dir:
+        for month, path in archive_months(archive_dir).items():
+            if since and month < (since.year, since.month):
+                continue
+            yield from iter_transaction_rows(path, 'transactions')
+    yield from iter_transaction_rows(xlsx_file_path, sheet_name)
+
+
+def write_archive(path, rows):
+    """Атомарно записывает архивную книгу в режиме write-only."""
+    workbook = Workbook(write_only=True)
+    transaction_sheet = workbook.create_sheet('transactions')
+    transaction_sheet.append(TRANSACTION_COLUMNS)
+    for row in rows:
+        transaction_sheet.append(row)
+    tmp_path = path + '.tmp'
+    save_workbook(workbook, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def rotate_transactions(xlsx_file_path, sheet_name, archive_dir, today=None):
+    """Переносит транзакции закрытых месяцев в архивные книги.
+
+    В живом листе остаются транзакции текущего месяца и строки без
+    разбираемой даты, пустые ряды при этом отбрасываются. Если архив месяца
+    уже есть (оплата из журнала пришла после ротации), строки дописываются
+    к нему. Возвращает количество перенесённых транзакций.
+    """
+    if not os.path.exists(path=xlsx_file_path):
+        return 0
+    today = today or datetime.date.today()
+    current = (today.year, today.month)
+    workbook = open_workbook(xlsx_file_path)
+    if sheet_name not in workbook.sheetnames:
+        workbook.close()
+        return 0
+    closed = dict()
+    live_rows = list()
+    for row in workbook[sheet_name].iter_rows(
+            min_row=2, max_col=len(TRANSACTION_COLUMNS), values_only=True):
+        if not row or not row[0]:
+            continue
+        day = parse_transaction_date(row[8])
+        if day and (day.year, day.month) < current:
+            closed.setdefault((day.year, day.month), list()).append(row)
+        else:
+            live_rows.append(row)
+    if not closed:
+        workbook.close()
+        return 0
+    os.makedirs(archive_dir, exist_ok=True)
+    existing = archive_months(archive_dir)
+    for month, rows in sorted(closed.items()):
+        path = existing.get(month) or os.path.join(
+            archive_dir, ARCHIVE_NAME.format(*month)
+        )
+        archived = list(iter_transaction_rows(path, 'transactions'))
+        write_archive(path, archived + rows)
+    # Живой лист пересоздаём с оставшимися строками вместо построчного
+    # удаления
+    position = workbook.sheetnames.index(sheet_name)
+    workbook.remove(workbook[sheet_name])
+    transaction_sheet = workbook.create_sheet(sheet_name, position)
+    fill_transaction_headers(transaction_sheet)
+    for row in live_rows:
+        transaction_sheet.append(row)
+    save_workbook(workbook, xlsx_file_path)
+    workbook.close()
+    return sum(len(rows) for rows in closed.values())
+
+
+def calculate_total_marge(xlsx_file_path, period=1, total=False,
+                          archive_dir=None):
+    """Считает выручку за период в днях (включая сегодня) или суммарную.
+
+    С archive_dir учитываются и архивы закрытых месяцев.
+    """
+    if os.path.exists(path=xlsx_file_path):
+        since = datetime.date.today() - datetime.timedelta(days=period - 1)
+        cur_amount = 0
+        for row in iter_all_transaction_rows(
+                xlsx_file_path, archive_dir=archive_dir,
+                since=None if total else since):
+            if not isinstance(row[1], (int, float)):
+                continue
+            if total:
+                cur_amount += row[1]
+                continue
+            day = parse_transaction_date(row[8])
+            if day and day >= since:
+                cur_amount += row[1]
+        return cur_amount
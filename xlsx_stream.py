@@ -0,0 +1,241 @@
+"""Потоковое чтение каталога напрямую из zip-архива xlsx.
+
+openpyxl строит объект для каждой ячейки книги, поэтому на каталогах в
+десятки тысяч строк запуск бота и /update заметно замедляются. Здесь XML
+листов читается инкрементальным парсером прямо из архива, а общие строки
+(sharedStrings.xml) разбираются лениво, ровно до самого большого индекса,
+который встретился в листах. Оба листа, товары и админы, читаются за одно
+открытие архива и дают тот же словарь товаров, что и collect_items.
+
+Переменная окружения XLSX_LOADER=openpyxl возвращает прежний способ
+чтения, например для сравнения результатов.
+"""
+import os
+import posixpath
+import re
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+from openpyxl.formula.translate import Translator
+from openpyxl.utils.datetime import from_ISO8601
+from openpyxl.worksheet.formula import ArrayFormula, DataTableFormula
+
+from metrics import timed
+from xlsx_parser import build_item, collect_admins_id, collect_items
+
+XLSX_LOADER = os.getenv('XLSX_LOADER', 'stream')
+
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = (
+    '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+)
+PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+SHARED_STRINGS_TYPE = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+    'sharedStrings'
+)
+
+CELL_REF = re.compile(r'([A-Z]+)')
+
+
+def column_index(ref):
+    """Номер колонки с нуля по адресу ячейки вида "AB12"."""
+    letters = CELL_REF.match(ref).group(1)
+    idx = 0
+    for letter in letters:
+        idx = idx * 26 + ord(letter) - 64
+    return idx - 1
+
+
+def cast_number(value):
+    """Число из текста ячейки по тем же правилам, что и в openpyxl."""
+    if '.' in value or 'E' in value or 'e' in value:
+        return float(value)
+    return int(value)
+
+
+def element_text(element):
+    """Текст строки, в том числе с форматированными фрагментами."""
+    return ''.join(node.text or '' for node in element.iter(MAIN_NS + 't'))
+
+
+class LazySharedStrings:
+    """Таблица общих строк, которая читается по мере обращения к ней."""
+
+    def __init__(self, archive, path):
+        self._strings = list()
+        self._events = None
+        if path in archive.namelist():
+            self._events = iterparse(archive.open(path), events=('end',))
+
+    def __getitem__(self, idx):
+        while idx >= len(self._strings) and self._events is not None:
+            try:
+                _, element = next(self._events)
+            except StopIteration:
+                self._events = None
+                break
+            if element.tag == MAIN_NS + 'si':
+                self._strings.append(element_text(element))
+                element.clear()
+        return self._strings[idx]
+
+
+def sheet_paths(archive):
+    """Пути XML листов по их названиям и путь таблицы общих строк."""
+    relations = dict()
+    shared_strings = 'xl/sharedStrings.xml'
+    with archive.open('xl/_rels/workbook.xml.rels') as file:
+        for _, element in iterparse(file):
+            if element.tag != PKG_REL_NS + 'Relationship':
+                continue
+            target = element.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join('xl', target))
+            relations[element.get('Id')] = target
+            if element.get('Type') == SHARED_STRINGS_TYPE:
+                shared_strings = target
+    sheets = dict()
+    with archive.open('xl/workbook.xml') as file:
+        for _, element in iterparse(file):
+            if element.tag == MAIN_NS + 'sheet':
+                sheets[element.get('name')] = relations.get(
+                    element.get(REL_NS + 'id')
+                )
+    return sheets, shared_strings
+
+
+def formula_value(cell, formula, shared_formulae):
+    """Текст формулы ячейки, как его возвращает openpyxl.
+
+    Ячейки общей формулы (t="shared") хранят её текст только в первой
+    ячейке, остальные получают его сдвигом ссылок, поэтому уже
+    встреченные общие формулы листа запоминаются в shared_formulae.
+    """
+    coordinate = cell.get('r')
+    value = '=' + (formula.text or '')
+    formula_type = formula.get('t')
+    if formula_type == 'array':
+        return ArrayFormula(ref=formula.get('ref'), text=value)
+    if formula_type == 'dataTable':
+        return DataTableFormula(**formula.attrib)
+    if formula_type == 'shared':
+        idx = formula.get('si')
+        if idx in shared_formulae:
+            return shared_formulae[idx].translate_formula(coordinate)
+        if value != '=':
+            shared_formulae[idx] = Translator(value, coordinate)
+    return value
+
+
+def cell_value(cell, shared_strings, shared_formulae=None):
+    """Значение ячейки с учётом её типа.
+
+    Для ячейки с формулой, как и в openpyxl, возвращается текст формулы, а
+    не закэшированный результат: его <v> может быть пустым, если книгу
+    пересохранили без пересчёта.
+    """
+    cell_type = cell.get('t', 'n')
+    formula = cell.find(MAIN_NS + 'f')
+    if formula is not None:
+        return formula_value(
+            cell, formula, dict() if shared_formulae is None
+            else shared_formulae
+        )
+    if cell_type == 'inlineStr':
+        inline = cell.find(MAIN_NS + 'is')
+        return element_text(inline) if inline is not None else None
+    # Пустой <v/> означает пустую ячейку
+    value = cell.findtext(MAIN_NS + 'v') or None
+    if value is None:
+        return None
+    if cell_type == 's':
+        return shared_strings[int(value)]
+    if cell_type == 'n':
+        return cast_number(value)
+    if cell_type == 'b':
+        return value == '1'
+    if cell_type == 'd':
+        return from_ISO8601(value)
+    return value
+
+
+def iter_sheet_rows(archive, path, shared_strings, min_row=1):
+    """Значения рядов листа, начиная с min_row, без загрузки всего XML."""
+    row_number = 0
+    shared_formulae = dict()
+    for _, element in iterparse(archive.open(path), events=('end',)):
+        if element.tag != MAIN_NS + 'row':
+            continue
+        row_number = int(element.get('r', row_number + 1))
+        if row_number >= min_row:
+            values = list()
+            for cell in element.iter(MAIN_NS + 'c'):
+                ref = cell.get('r')
+                idx = column_index(ref) if ref else len(values)
+                if idx >= len(values):
+                    values.extend([None] * (idx - len(values) + 1))
+                values[idx] = cell_value(
+                    cell, shared_strings, shared_formulae
+                )
+            yield values
+        element.clear()
+
+
+def stream_shop(xlsx_file_path, items_sheet='shop', admins_sheet='admin'):
+    """Товары и айди админов за одно открытие архива xlsx."""
+    items = dict()
+    admins = list()
+    with zipfile.ZipFile(xlsx_file_path) as archive:
+        sheets, shared_strings_path = sheet_paths(archive)
+        shared_strings = LazySharedStrings(archive, shared_strings_path)
+        if sheets.get(items_sheet):
+            for row in iter_sheet_rows(
+                    archive, sheets[items_sheet], shared_strings, min_row=2):
+                if row and row[0]:
+                    # Ряд короче пяти колонок дополняем пустыми значениями,
+                    # как это делает openpyxl
+                    row.extend([None] * (5 - len(row)))
+                    items[row[0]] = build_item(row)
+        if sheets.get(admins_sheet):
+            for row in iter_sheet_rows(
+                    archive, sheets[admins_sheet], shared_strings, min_row=2):
+                if row and row[0]:
+                    admins.append(row[0])
+    return items, admins
+
+
+def load_sheet_rows(xlsx_file_path, sheet_name, min_row=2):
+    """Значения рядов одного листа или пустой список, если его нет."""
+    if not os.path.exists(path=xlsx_file_path):
+        return list()
+    with zipfile.ZipFile(xlsx_file_path) as archive:
+        sheets, shared_strings_path = sheet_paths(archive)
+        if not sheets.get(sheet_name):
+            return list()
+        shared_strings = LazySharedStrings(archive, shared_strings_path)
+        return [
+            row for row in iter_sheet_rows(
+                archive, sheets[sheet_name], shared_strings, min_row=min_row
+            )
+            if any(value is not None for value in row)
+        ]
+
+
+def load_shop(xlsx_file_path, items_sheet='shop', admins_sheet='admin',
+              loader=None):
+    """Товары и айди админов выбранным способом чтения.
+
+    Возвращает (None, None), если файла нет, как и функции collect_*.
+    """
+    if not os.path.exists(path=xlsx_file_path):
+        return None, None
+    if (loader or XLSX_LOADER) == 'openpyxl':
+        return (
+            collect_items(xlsx_file_path, items_sheet),
+            collect_admins_id(xlsx_file_path, admins_sheet)
+        )
+    with timed('excel_load_seconds', mode='stream'):
+        return stream_shop(xlsx_file_path, items_sheet, admins_sheet)